@@ -0,0 +1,54 @@
+"""empty message
+
+Revision ID: a5136b75c1a7
+Revises: a4861fcb8f06
+Create Date: 2026-10-18 18:20:11.402113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "a5136b75c1a7"
+down_revision = "a4861fcb8f06"
+branch_labels = None
+depends_on = None
+
+FILTER_INDEXES = {
+    "apartments": [
+        ["district", "residential_complex"],
+        ["rooms"],
+        ["currency", "rent_price"],
+    ],
+    "houses": [["district"], ["rooms"], ["currency", "rent_price"], ["living_area"]],
+}
+
+
+def upgrade() -> None:
+    for table, filter_indexes in FILTER_INDEXES.items():
+        # Sync looks listings up by link, so duplicates could only come from older syncs
+        op.execute(
+            f"DELETE FROM {table} a USING {table} b WHERE a.link = b.link AND a.id < b.id"
+        )
+        op.create_index(f"ix_{table}_link", table, ["link"], unique=True)
+        op.create_index(f"ix_{table}_created_at_id", table, ["created_at", "id"])
+        for columns in filter_indexes:
+            op.create_index(f'ix_{table}_{"_".join(columns)}', table, columns)
+
+    op.create_index(
+        "ix_geodata_coordinates_geography",
+        "geodata",
+        [sa.text("CAST(coordinates AS geography)")],
+        postgresql_using="gist",
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_geodata_coordinates_geography", table_name="geodata")
+
+    for table, filter_indexes in FILTER_INDEXES.items():
+        for columns in filter_indexes:
+            op.drop_index(f'ix_{table}_{"_".join(columns)}', table_name=table)
+        op.drop_index(f"ix_{table}_created_at_id", table_name=table)
+        op.drop_index(f"ix_{table}_link", table_name=table)
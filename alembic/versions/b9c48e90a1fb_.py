@@ -0,0 +1,39 @@
+"""empty message
+
+Revision ID: b9c48e90a1fb
+Revises: 0007d18f1b9c
+Create Date: 2026-10-18 19:31:05.843920
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "b9c48e90a1fb"
+down_revision = "0007d18f1b9c"
+branch_labels = None
+depends_on = None
+
+TABLES = ["apartments", "houses"]
+
+
+def upgrade() -> None:
+    for table in TABLES:
+        op.add_column(table, sa.Column("price_uah", sa.Float(), nullable=True))
+        # Rates stored by the exchange rates refresher, the bot recomputes prices on start anyway
+        op.execute(
+            f"UPDATE {table} SET price_uah = rent_price * CASE WHEN currency = 'UAH' THEN 1 "
+            f"ELSE (SELECT rate FROM exchange_rates WHERE exchange_rates.currency = {table}.currency) END"
+        )
+        op.create_index(f"ix_{table}_price_uah", table, ["price_uah"])
+        op.drop_index(f"ix_{table}_currency_rent_price", table_name=table)
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        op.create_index(
+            f"ix_{table}_currency_rent_price", table, ["currency", "rent_price"]
+        )
+        op.drop_index(f"ix_{table}_price_uah", table_name=table)
+        op.drop_column(table, "price_uah")
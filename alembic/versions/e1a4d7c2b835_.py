@@ -0,0 +1,29 @@
+"""empty message
+
+Revision ID: e1a4d7c2b835
+Revises: 3c7e52d0a914
+Create Date: 2026-10-18 20:41:27.306115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "e1a4d7c2b835"
+down_revision = "3c7e52d0a914"
+branch_labels = None
+depends_on = None
+
+TABLES = ["apartments", "houses"]
+
+
+def upgrade() -> None:
+    # Filled by the next sync, rows without a hash are compared field by field once
+    for table in TABLES:
+        op.add_column(table, sa.Column("content_hash", sa.String(), nullable=True))
+
+
+def downgrade() -> None:
+    for table in TABLES:
+        op.drop_column(table, "content_hash")
@@ -0,0 +1,63 @@
+"""empty message
+
+Revision ID: fd8c4e04d493
+Revises: a5136b75c1a7
+Create Date: 2026-10-18 18:41:52.118530
+
+"""
+import geoalchemy2
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "fd8c4e04d493"
+down_revision = "a5136b75c1a7"
+branch_labels = None
+depends_on = None
+
+TABLES = ["apartments", "houses"]
+
+
+def upgrade() -> None:
+    for table in TABLES:
+        op.add_column(
+            table,
+            sa.Column(
+                "coordinates",
+                geoalchemy2.types.Geography(
+                    geometry_type="POINT",
+                    srid=4326,
+                    spatial_index=False,
+                    from_text="ST_GeogFromText",
+                    name="geography",
+                ),
+                nullable=True,
+            ),
+        )
+        op.execute(
+            f"UPDATE {table} SET coordinates = CAST(geodata.coordinates AS geography) "
+            f"FROM geodata "
+            f"WHERE geodata.address = {table}.address "
+            f"AND geodata.district = {table}.district "
+            f"AND geodata.map_link = {table}.maps_link"
+        )
+        op.create_index(
+            f"ix_{table}_coordinates", table, ["coordinates"], postgresql_using="gist"
+        )
+
+    # Radius search reads coordinates of listings now
+    op.drop_index("ix_geodata_coordinates_geography", table_name="geodata")
+
+
+def downgrade() -> None:
+    op.create_index(
+        "ix_geodata_coordinates_geography",
+        "geodata",
+        [sa.text("CAST(coordinates AS geography)")],
+        postgresql_using="gist",
+    )
+
+    for table in TABLES:
+        op.drop_index(f"ix_{table}_coordinates", table_name=table)
+        op.drop_column(table, "coordinates")
@@ -1,6 +1,9 @@
+import asyncio
 import os.path
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Optional, List
+from typing import Optional, List, Dict, Iterable, Tuple
 
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -18,9 +21,64 @@ SCOPES = ["https://www.googleapis.com/auth/drive",
           "https://www.googleapis.com/auth/spreadsheets",
           ]
 
+# googleapiclient and httplib2 block and aren't thread safe, so all calls go through one thread
+google_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="google-api")
+
+
+async def run_google_call(fn, *args, **kwargs):
+    """Runs a blocking Google API call off the event loop"""
+    return await asyncio.get_running_loop().run_in_executor(google_executor, partial(fn, *args, **kwargs))
+
+
+def get_column_letter(idx: int) -> str:
+    """:param idx: 0 based column index"""
+    letters = ""
+    idx += 1
+    while idx:
+        idx, rem = divmod(idx - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+
+def get_column_spans(indexes: List[int]) -> List[Tuple[int, int]]:
+    """Groups sorted column indexes into inclusive (first, last) runs of adjacent columns"""
+    spans = []
+    for idx in indexes:
+        if spans and spans[-1][1] == idx - 1:
+            spans[-1] = (spans[-1][0], idx)
+        else:
+            spans.append((idx, idx))
+    return spans
+
+
+def is_range_error(error: HttpError) -> bool:
+    """The range starts or ends past the last row of the sheet"""
+    return error.resp.status == 400 and "exceeds grid limits" in str(error)
+
+
+def join_column_spans(parts: List[Tuple[list, int]]) -> list:
+    """
+    Joins rows of column spans fetched separately, as a single range would return them:
+    empty cells are '' and trailing empty cells are omitted, so blank rows are [].
+    :param parts: [(rows of a span, span width)]
+    """
+    height = max((len(rows) for rows, _ in parts), default=0)
+    result = []
+    for i in range(height):
+        row = []
+        for rows, width in parts:
+            cells = rows[i] if i < len(rows) else []
+            row.extend(cells + [""] * (width - len(cells)))
+        while row and row[-1] == "":
+            row.pop()
+        result.append(row)
+    return result
+
 
 class GoogleApi:
     creds = None
+    # Spans of the needed columns per sheet, kept until the header changes
+    column_spans: Dict[str, List[Tuple[int, int]]] = {}
 
     def __init__(self, base_path: Optional[Path] = None):
         if base_path is None:
@@ -180,6 +238,82 @@ class GoogleApi:
 
         return values
 
+    def get_spreadsheet_revision(self, spreadsheet_id: str) -> str:
+        """Drive version and modifiedTime, both change on every edit of the spreadsheet"""
+        result = self.drive_service.files().get(fileId=spreadsheet_id, fields="version,modifiedTime").execute()
+        return f'{result.get("version")}:{result.get("modifiedTime")}'
+
+    def batch_get_values(self, ranges: List[str]) -> List[list]:
+        result = (
+            self.sheet_service.spreadsheets()
+            .values()
+            .batchGet(spreadsheetId=config.RENT_SPREADSHEET_ID, ranges=ranges)
+            .execute()
+        )
+        return [value_range.get("values", []) for value_range in result.get("valueRanges", [])]
+
+    def get_sheets_rows(
+            self, columns: Dict[str, Iterable[str]], first_row: int = 1, last_row: Optional[int] = None
+    ) -> Dict[str, list]:
+        """
+        Only the needed columns of several sheets, in one batchGet once their positions are known.
+        googleapiclient asks for gzip responses itself.
+        :param columns: {sheet name: header names of the needed columns}
+        :param first_row: 1 based, rows starting from the first one include the header
+        :param last_row: inclusive, None for all rows
+        :return: {sheet name: rows, columns in sheet order}
+        """
+        columns = {sheet_name: set(names) for sheet_name, names in columns.items()}
+        result = {}
+        for _ in range(2):
+            unknown = [sheet_name for sheet_name in columns if sheet_name not in self.column_spans]
+            if unknown:
+                headers = self.batch_get_values([f"{sheet_name}!1:1" for sheet_name in unknown])
+                for sheet_name, rows in zip(unknown, headers):
+                    header = rows[0] if rows else []
+                    indexes = [i for i, name in enumerate(header) if name in columns[sheet_name]]
+                    self.column_spans[sheet_name] = get_column_spans(indexes)
+
+            last = last_row or ""
+            ranges = [
+                (sheet_name, f"{sheet_name}!{get_column_letter(first_col)}{first_row}:{get_column_letter(last_col)}{last}",
+                 last_col - first_col + 1)
+                for sheet_name in columns
+                for first_col, last_col in self.column_spans[sheet_name]
+            ]
+            values = self.batch_get_values([range_name for _, range_name, _ in ranges]) if ranges else []
+            result = {
+                sheet_name: join_column_spans(
+                    [(rows, width) for (name, _, width), rows in zip(ranges, values) if name == sheet_name]
+                )
+                for sheet_name in columns
+            }
+            if first_row != 1:
+                break
+
+            # Columns were moved since the positions were read
+            moved = [
+                sheet_name for sheet_name, names in columns.items()
+                if not names <= set(result[sheet_name][0] if result[sheet_name] else [])
+            ]
+            if not moved:
+                break
+            for sheet_name in moved:
+                del self.column_spans[sheet_name]
+        return result
+
+    def get_sheet_row_counts(self) -> Dict[str, int]:
+        """:return: {sheet name: rows in the grid, blank ones included}"""
+        result = (
+            self.sheet_service.spreadsheets()
+            .get(spreadsheetId=config.RENT_SPREADSHEET_ID, fields="sheets.properties(title,gridProperties.rowCount)")
+            .execute()
+        )
+        return {
+            sheet["properties"]["title"]: sheet["properties"]["gridProperties"]["rowCount"]
+            for sheet in result.get("sheets", [])
+        }
+
     def batch_update_google_maps_link_by_row_idx(self, indexes: List[int], g_maps_link: str):
         try:
             results = []
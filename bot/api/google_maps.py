@@ -1,35 +1,50 @@
+from typing import Optional
 from urllib.parse import quote_plus
 
-import googlemaps
-import requests
+import httpx
 
 from bot import config
 
+FIND_PLACE_URL = "https://maps.googleapis.com/maps/api/place/findplacefromtext/json"
+FIND_PLACE_FIELDS = "formatted_address,name,geometry"
+REQUEST_TIMEOUT = 10.0
 
-class GoogleMapsApi:
-    def __init__(self):
-        self.gmaps = googlemaps.Client(key=config.G_MAPS_API)
-
-    def get_geodata_by_address(self, address):
-
-        url = f"https://maps.googleapis.com/maps/api/place/findplacefromtext/json?input={quote_plus(address)}&inputtype=textquery&fields=formatted_address%2Cname%2Crating%2Copening_hours%2Cgeometry&key={config.G_MAPS_API}"
 
-        response = requests.request("GET", url, headers={}, data={})
-
-        return_data = None
+class GoogleMapsApi:
+    def __init__(self, client: Optional[httpx.AsyncClient] = None):
+        self.client = client or httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+
+    async def get_geodata_by_address(self, address: str) -> Optional[dict]:
+        """:raises ValueError: on error statuses of the API, the address may be found on retry"""
+        params = {
+            "input": address,
+            "inputtype": "textquery",
+            "fields": FIND_PLACE_FIELDS,
+            "key": config.G_MAPS_API,
+        }
+        response = await self.client.get(FIND_PLACE_URL, params=params)
+        response.raise_for_status()
 
         data = response.json()
-        if len(data['candidates']):
-            result = data['candidates'][0]
-
-            if 'geometry' in result and 'location' in result.get('geometry'):
-                location = result.get('geometry').get('location')
-                return_data = {
-                    'google_maps_link': f'https://www.google.com/maps/place/?t=k&q={location["lat"]},{location["lng"]}',
-                    'coordinates': location,
-                }
-
-            if 'name' in result:
-                return_data['google_maps_link'] = f"https://maps.google.com/?t=k&q={quote_plus(address)}"
+        # Errors come with HTTP 200 too, only ZERO_RESULTS means the address isn't found
+        status = data.get('status')
+        if status == 'ZERO_RESULTS':
+            return None
+        if status != 'OK':
+            raise ValueError(f"Places API answered {status}: {data.get('error_message')}")
+        if not data.get('candidates'):
+            return None
+
+        result = data['candidates'][0]
+        location = result.get('geometry', {}).get('location')
+        if location is None:
+            return None
+
+        return_data = {
+            'google_maps_link': f'https://www.google.com/maps/place/?t=k&q={location["lat"]},{location["lng"]}',
+            'coordinates': location,
+        }
+        if 'name' in result:
+            return_data['google_maps_link'] = f"https://maps.google.com/?t=k&q={quote_plus(address)}"
 
         return return_data
@@ -1,9 +1,16 @@
-from typing import Literal
+import asyncio
+import random
+from typing import Dict, Optional
 
-import requests
-from cachetools.func import ttl_cache
+import httpx
+
+from bot.config import MONOBANK_URL
+from bot.db import get_stored_exchange_rates, save_exchange_rates, bump_data_version, update_all_normalized_prices
+from bot.listing_index import rebuild_listing_indexes
+from bot.log import logging
+
+logger = logging.getLogger(__name__)
 
-URL = "https://api.monobank.ua/bank/currency"
 USD_CODE = 840
 UAH_CODE = 980
 EUR_CODE = 978
@@ -12,12 +19,40 @@ CURRENCY_MAPPING = {
     "EUR": EUR_CODE,
 }
 
+# Monobank allows one request per 5 minutes
+REFRESH_INTERVAL = 600.0
+REFRESH_JITTER = 60.0
+REQUEST_TIMEOUT = 10.0
+
+_rates: Dict[str, float] = {"UAH": 1}
+
+
+def get_exchange_rates() -> Dict[str, float]:
+    """Last known rates to UAH, currencies without a rate yet are missing"""
+    return _rates
+
 
-@ttl_cache(600.0)
-def get_exchange_rates():
-    r = requests.get(URL)
-    response_data = r.json()
-    result = {"UAH": 1}
+def set_exchange_rates(rates: Dict[str, Optional[float]]) -> bool:
+    """
+    Currencies missing from a partial response keep their last known rate.
+    :return: whether the rates have changed
+    """
+    global _rates
+    rates = {**_rates, **get_known_rates(rates), "UAH": 1}
+    if rates == _rates:
+        return False
+    _rates = rates
+    # Price filters select different listings now
+    bump_data_version()
+    return True
+
+
+def get_known_rates(rates: Dict[str, Optional[float]]) -> Dict[str, float]:
+    return {currency: rate for currency, rate in rates.items() if rate is not None}
+
+
+def parse_exchange_rates(response_data: list) -> Dict[str, Optional[float]]:
+    result = {}
     for k, v in CURRENCY_MAPPING.items():
         rate = next(
             (
@@ -29,3 +64,52 @@ def get_exchange_rates():
         )
         result[k] = rate
     return result
+
+
+async def fetch_exchange_rates(client: httpx.AsyncClient) -> Dict[str, Optional[float]]:
+    r = await client.get(MONOBANK_URL)
+    r.raise_for_status()
+    return parse_exchange_rates(r.json())
+
+
+async def refresh_exchange_rates(client: httpx.AsyncClient):
+    """Fetches rates, on failure the last known ones stay in use"""
+    try:
+        rates = await fetch_exchange_rates(client)
+    except (httpx.HTTPError, ValueError, KeyError, TypeError):
+        logger.warning("Can't fetch exchange rates from %s", MONOBANK_URL, exc_info=True)
+        return
+
+    if set_exchange_rates(rates):
+        await save_exchange_rates(get_known_rates(rates))
+        await apply_exchange_rates()
+        logger.info("Exchange rates updated: %s", rates)
+
+
+async def apply_exchange_rates():
+    """Reprices listings in UAH, the listing index holds the prices too"""
+    await update_all_normalized_prices(get_exchange_rates())
+    await rebuild_listing_indexes()
+
+
+async def load_exchange_rates():
+    """Rates stored by the previous run, so price filters work before the first fetch"""
+    rates = await get_stored_exchange_rates()
+    if rates and set_exchange_rates(rates):
+        await apply_exchange_rates()
+
+
+async def run_exchange_rates_refresher():
+    """Background task keeping rates in memory fresh, callers never wait for Monobank"""
+    try:
+        await load_exchange_rates()
+    except Exception:
+        logger.exception("Can't load stored exchange rates")
+
+    async with httpx.AsyncClient(timeout=REQUEST_TIMEOUT) as client:
+        while True:
+            try:
+                await refresh_exchange_rates(client)
+            except Exception:
+                logger.exception("Exchange rates refresh failed")
+            await asyncio.sleep(REFRESH_INTERVAL + random.uniform(-REFRESH_JITTER, REFRESH_JITTER))
@@ -0,0 +1,34 @@
+from typing import Any, Hashable, Optional
+
+from cachetools import LRUCache
+
+
+class VersionedLRUCache:
+    """
+    Size-bounded LRU cache whose entries are tagged with the data version they were built for.
+    An entry built for an older version is treated as a miss, so stale values are never served.
+    """
+
+    def __init__(self, maxsize: int):
+        self.cache = LRUCache(maxsize=maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, version: int) -> Optional[Any]:
+        entry = self.cache.get(key)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, version: int, value: Any):
+        self.cache[key] = (version, value)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": self.cache.currsize,
+            "maxsize": self.cache.maxsize,
+        }
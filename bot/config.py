@@ -26,5 +26,7 @@ RENT_APARTMENTS_SHEET_NAME = os.environ["RENT_APARTMENTS_SHEET_NAME"]
 G_MAPS_API = os.environ["G_MAPS_API"]
 RENT_SHEET_ID = os.environ["RENT_SHEET_ID"]
 
+MONOBANK_URL = os.environ.get("MONOBANK_URL") or "https://api.monobank.ua/bank/currency"
+
 
 
@@ -0,0 +1,49 @@
+from typing import Any, Dict, List
+
+from bot.db import get_chain_facets
+from bot.listing_index import get_listing_index
+
+
+class FacetEngine:
+    """
+    Memo of filter facets ({value: count} of the column a filter selects from)
+    and of result counts along the filter chain.
+    Manager keeps one engine per update, so keyboards, texts and queries
+    of every filter share a single fetch of each facet.
+    """
+
+    def __init__(self):
+        self.facets: Dict[int, Dict[Any, int]] = {}
+        self.counts: Dict[int, int] = {}
+
+    async def get_facets(self, f) -> Dict[Any, int]:
+        key = id(f)
+        if key not in self.facets:
+            self.facets[key] = await f.fetch_facets()
+        return self.facets[key]
+
+    async def get_count(self, f) -> int:
+        key = id(f)
+        if key not in self.counts:
+            self.counts[key] = await f.fetch_count()
+        return self.counts[key]
+
+    async def prefetch(self, filters: List):
+        """
+        Fetches facets of all given filters in a single query.
+        Filters have to be a chain, ordered from the first one.
+        """
+        pending = [
+            f
+            for f in filters
+            if f.get_facet_column() is not None and id(f) not in self.facets
+        ]
+        if len(pending) < 2 or get_listing_index(pending[0].model) is not None:
+            # Nothing to batch, or facets are computed in memory anyway
+            return
+
+        result = await get_chain_facets(
+            [(f.get_query(), f.get_facet_column()) for f in pending]
+        )
+        for f, facets in zip(pending, result):
+            self.facets[id(f)] = facets
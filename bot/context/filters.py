@@ -1,15 +1,17 @@
 import json
 from collections import defaultdict
-from typing import Dict, List, Optional, Type, TypedDict
+from typing import Dict, Hashable, List, Optional, Tuple, Type, TypedDict
 
-from sqlalchemy import or_, and_, Column, func
+import numpy as np
+from sqlalchemy import or_, and_, Column
 from sqlalchemy import select
 from sqlalchemy.sql import Select
 from telegram import InlineKeyboardButton, Update
 from telegram.ext import ContextTypes
 
-from bot.api.monobank_currency import get_exchange_rates
+from bot.context.facets import FacetEngine
 from bot.context.payload import Payload
+from bot.context.render_cache import get_or_render
 from bot.data_manager import (
     KIDS_FILTER_TEXT,
     KIDS_ABOVE_SIX_YO_PROP,
@@ -20,9 +22,10 @@ from bot.data_manager import (
     OTHER_ANIMALS_PROP,
     ALL_PETS_ALLOWED_PROP,
 )
-from bot.db import get_unique_el_from_db
+from bot.db import get_facets, get_result_count, make_point, dwithin, get_radius_counts
+from bot.listing_index import ListingIndex, get_listing_index
 from bot.log import logging
-from bot.models import Ad, Apartments, Houses, GeoData
+from bot.models import Ad, Apartments, Houses
 from bot.navigation.buttons_constants import (
     get_next_btn,
     NEXT_BTN_TEXT,
@@ -33,9 +36,10 @@ from bot.navigation.buttons_constants import (
 
 
 def function_logger(func):
-    async def wrapper(*args, **kwargs):
-        q = await func(*args, **kwargs)
-        logging.info(q)
+    def wrapper(*args, **kwargs):
+        q = func(*args, **kwargs)
+        # Rendering SQL is as costly as compiling it, so only in debug mode
+        logging.debug(q)
         return q
 
     return wrapper
@@ -46,6 +50,7 @@ SELECT_ALL = "s"
 PAGE_IDX = "p"
 DISTRICT_FILTER_MODE = "mode"
 SELECTED_RADIUS = "radius"
+RADIUS_COUNTS = "radius_counts"
 
 ITEMS_PER_PAGE = 20
 
@@ -58,6 +63,7 @@ class BaseFilterState(TypedDict):
 
 class BaseFilter:
     __query: Optional[Select]
+    __mask: Optional[tuple]
     name: str
     select_all_text = "Обрати всі ✅"
     unselect_all_text = "Зняти виділення з усіх ❌"
@@ -70,12 +76,14 @@ class BaseFilter:
             state: Optional[BaseFilterState],
             prev_filter: Optional["BaseFilter"] = None,
             name: Optional[str] = None,
+            facet_engine: Optional[FacetEngine] = None,
     ):
 
         if name:
             self.name = name
         self.model = model
         self.prev_filter = prev_filter
+        self.facet_engine = facet_engine or FacetEngine()
         self.state = state or {
             SELECTED_VALUES: {},  # Selected values
             SELECT_ALL: None,  # Select all
@@ -83,6 +91,7 @@ class BaseFilter:
         }
         self.state[SELECTED_VALUES] = defaultdict(bool, self.state[SELECTED_VALUES])
         self.__query = None
+        self.__mask = None
 
     @property
     def values(self) -> Dict:
@@ -109,17 +118,30 @@ class BaseFilter:
         self.state[SELECT_ALL] = value
 
     @function_logger
-    async def build_query(self):
-        return (await self.get_query()).filter()
+    def build_query(self):
+        return self.get_query().filter()
 
-    async def get_query(self):
+    def get_query(self):
         if self.__query is None:
             if self.prev_filter is not None:
-                self.__query = await self.prev_filter.build_query()
+                self.__query = self.prev_filter.build_query()
             else:
                 self.__query = select(self.model)
         return self.__query
 
+    def build_mask(self, index: ListingIndex) -> np.ndarray:
+        """Same as build_query, but evaluated against the in-memory listing index"""
+        return self.get_mask(index)
+
+    def get_mask(self, index: ListingIndex) -> np.ndarray:
+        if self.__mask is None or self.__mask[0] is not index:
+            if self.prev_filter is not None:
+                mask = self.prev_filter.build_mask(index)
+            else:
+                mask = index.all()
+            self.__mask = (index, mask)
+        return self.__mask[1]
+
     def build_next_btn(self):
         next_text = SKIP_BTN_TEXT
         if self.has_values():
@@ -138,6 +160,8 @@ class BaseFilter:
                 ITEMS_PER_PAGE * self.page_idx: (self.page_idx + 1) * ITEMS_PER_PAGE
                 ]
 
+        counts = await self.get_item_counts()
+
         keyboard = []
         row = []
         for i, item in enumerate(items):
@@ -148,6 +172,8 @@ class BaseFilter:
                 }
             )
             title = item_value
+            if item_value in counts:
+                title = f"{title} ({counts[item_value]})"
             if self.values.get(item_value):
                 title = f"{title} ✅"
             row.append(get_regular_btn(title, data))
@@ -191,6 +217,33 @@ class BaseFilter:
                 )
         return keyboard
 
+    def get_canonical_state(self) -> str:
+        state = dict(self.state)
+        state[SELECTED_VALUES] = {k: v for k, v in self.values.items() if v}
+        return json.dumps(state, sort_keys=True, ensure_ascii=False)
+
+    def get_render_key(self, *args) -> Hashable:
+        """Everything a rendered keyboard or text of the filter depends on, besides the data version"""
+        states = []
+        f = self
+        while f is not None:
+            states.append(f.get_canonical_state())
+            f = f.prev_filter
+        return type(self).__name__, self.model.__tablename__, tuple(states), self.page_idx, *args
+
+    async def render_keyboard(self) -> List[List[InlineKeyboardButton]]:
+        """build_keyboard served from the render cache"""
+        keyboard = await get_or_render(self.get_render_key("keyboard"), self.build_keyboard)
+        # Rows are copied, callers append navigation to them
+        return [list(row) for row in keyboard]
+
+    async def render_text(self, is_final=False, is_active=False) -> str:
+        """build_text served from the render cache"""
+        return await get_or_render(
+            self.get_render_key("text", is_final, is_active),
+            lambda: self.build_text(is_final=is_final, is_active=is_active),
+        )
+
     #
     async def process_action(self, payload: Payload, update: Update, context: ContextTypes.DEFAULT_TYPE):
         items = await self.get_items()
@@ -226,9 +279,54 @@ class BaseFilter:
     async def get_items(self):
         return []
 
+    async def get_item_counts(self) -> Dict[str, int]:
+        """Number of listings behind each button, given the previous filters"""
+        return {}
+
+    async def get_count(self) -> int:
+        """Number of listings matching the filter chain up to and including this filter"""
+        return await self.facet_engine.get_count(self)
+
+    async def get_query_count(self) -> int:
+        """Number of listings left after the previous filters"""
+        if self.prev_filter is not None:
+            return await self.prev_filter.get_count()
+        index = get_listing_index(self.model)
+        if index is not None:
+            return index.count(self.get_mask(index))
+        return await get_result_count(self.get_query())
+
+    async def fetch_count(self) -> int:
+        index = get_listing_index(self.model)
+        if index is not None:
+            return index.count(self.build_mask(index))
+        return await get_result_count(self.build_query())
+
+    def get_facet_column(self) -> Optional[Column]:
+        """Column the filter buttons are built from, if any"""
+        return None
+
+    async def get_facets(self) -> Dict:
+        """Values of the facet column available after the previous filters, with counts"""
+        return await self.facet_engine.get_facets(self)
+
+    async def fetch_facets(self) -> Dict:
+        col = self.get_facet_column()
+        index = get_listing_index(self.model)
+        if index is not None:
+            return index.facets(col.key, self.get_mask(index))
+        facets = await get_facets(self.get_query(), [col])
+        return facets[col.key]
+
     def allow_back(self):
         return True
 
+    def get_location(self) -> Optional[Tuple[float, float]]:
+        """(lat, lng) results are ordered by distance to, if any filter of the chain searches by location"""
+        if self.prev_filter is not None:
+            return self.prev_filter.get_location()
+        return None
+
 
 class ColumnFilter(BaseFilter):
     has_select_all = True
@@ -236,41 +334,65 @@ class ColumnFilter(BaseFilter):
     def get_column(self) -> Column:
         raise NotImplementedError()
 
+    def get_facet_column(self) -> Optional[Column]:
+        return self.get_column()
+
     async def get_items(self):
-        data = await get_unique_el_from_db(await self.get_query(), self.get_column())
-        return data
+        return list(await self.get_facets())
+
+    async def get_item_counts(self) -> Dict[str, int]:
+        return await self.get_facets()
+
+    async def fetch_count(self) -> int:
+        # Selected values always come from the facets, so their counts add up to the result
+        filtered_data = self.get_selected_values()
+        if self.select_all or not len(filtered_data):
+            return await self.get_query_count()
+        facets = await self.get_facets()
+        return sum(facets.get(v, 0) for v in filtered_data)
+
+    def get_selected_values(self) -> list:
+        python_type = self.get_column().type.python_type
+        return [python_type(k) for k, v in self.values.items() if v]
 
     @function_logger
-    async def build_query(self):
-        query = await self.get_query()
+    def build_query(self):
+        query = self.get_query()
         if self.select_all:
             return query
 
-        data = await self.get_items()
-        filtered_data = []
-
-        for datum in data:
-            if self.values[str(datum)]:
-                filtered_data.append(datum)
-
+        filtered_data = self.get_selected_values()
         if len(filtered_data):
             return query.filter(self.get_column().in_(filtered_data))
         return query.filter()
 
+    def build_mask(self, index: ListingIndex) -> np.ndarray:
+        mask = self.get_mask(index)
+        if self.select_all:
+            return mask
+
+        filtered_data = self.get_selected_values()
+        if len(filtered_data):
+            return mask & index.isin(self.get_column().key, filtered_data)
+        return mask
+
 
 class DistrictFilterState(BaseFilterState):
     district_filter_mode: str
     provided_location: Optional[dict[str, float]]
     provided_radius: Optional[int]
+    radius_counts: Optional[dict[str, int]]
 
 
 class DistrictFilter(ColumnFilter):
     name = "Райони"
     state: DistrictFilterState
 
+    RADIUSES = [1, 2, 3, 5]
+
     def __init__(self, model: Type[Ad], state: BaseFilterState, prev_filter: Optional["BaseFilter"] = None,
-                 name: Optional[str] = None):
-        super().__init__(model, state, prev_filter, name)
+                 name: Optional[str] = None, facet_engine: Optional[FacetEngine] = None):
+        super().__init__(model, state, prev_filter, name, facet_engine)
 
         if self.mode is None:
             self.state['district_filter_mode'] = 'selection'
@@ -304,6 +426,7 @@ class DistrictFilter(ColumnFilter):
     def clean_location_data(self):
         self.state['provided_location'] = None
         self.state['provided_radius'] = None
+        self.state[RADIUS_COUNTS] = None
 
     def clean_provided_location(self):
         self.state['provided_location'] = None
@@ -341,15 +464,18 @@ class DistrictFilter(ColumnFilter):
         elif self.is_location_mode():
             if self.get_location_provided():
                 row = []
-                radiuses = ['1', '2', '3', '5']
-                for item in radiuses:
+                radius_counts = self.state.get(RADIUS_COUNTS) or {}
+                for radius in self.RADIUSES:
+                    item = str(radius)
                     data = json.dumps(
                         {
                             SELECTED_RADIUS: item,
                         }
                     )
                     title = item + ' км'
-                    if self.get_provided_radius() == item:
+                    if item in radius_counts:
+                        title = f"{title} ({radius_counts[item]})"
+                    if self.get_provided_radius() == radius:
                         title = f"{title} ✅"
                     row.append(get_regular_btn(title, data))
                 keyboard.append(row)
@@ -404,6 +530,7 @@ class DistrictFilter(ColumnFilter):
                 }
                 await update.message.delete()
                 self.values = {}
+                self.state[RADIUS_COUNTS] = await self.count_by_radius()
 
         if SELECT_BY_DISTRICT in payload.callback:
             self.mode = "district"
@@ -420,19 +547,49 @@ class DistrictFilter(ColumnFilter):
             self.state['provided_radius'] = int(payload.callback[SELECTED_RADIUS])
         return dict(self.state)
 
-    async def build_query(self):
+    def get_point(self):
+        return make_point(self.state['provided_location']['latitude'],
+                          self.state['provided_location']['longitude'])
+
+    def get_location(self) -> Optional[Tuple[float, float]]:
+        if self.has_geodata_values():
+            return self.state['provided_location']['latitude'], self.state['provided_location']['longitude']
+        return super().get_location()
+
+    async def count_by_radius(self) -> Dict[str, int]:
+        """
+        Number of listings within each of the radius buttons around the provided location.
+        Computed once per location and kept in the state, so the buttons show counts without queries.
+        """
+        radiuses_m = [radius * 1000 for radius in self.RADIUSES]
+        index = get_listing_index(self.model)
+        if index is not None:
+            counts = index.count_within(self.get_mask(index),
+                                        self.state['provided_location']['latitude'],
+                                        self.state['provided_location']['longitude'],
+                                        radiuses_m)
+        else:
+            counts = await get_radius_counts(self.get_query(), self.get_point(), radiuses_m)
+        return {str(radius): count for radius, count in zip(self.RADIUSES, counts)}
+
+    def build_query(self):
         if self.has_geodata_values():
-            query = await self.get_query()
-            query: Select = query.join(GeoData,
-                                       and_(GeoData.address == self.model.address,
-                                            GeoData.district == self.model.district,
-                                            self.model.maps_link == GeoData.map_link),
-                                       isouter=True)
-
-            point = func.ST_MakePoint(self.state['provided_location']['longitude'],
-                                      self.state['provided_location']['latitude'])
-            return query.filter(func.ST_DistanceSphere(GeoData.coordinates, point) < self.get_provided_radius() * 1000)
-        return await super().build_query()
+            within = dwithin(self.model.coordinates, self.get_point(), self.get_provided_radius() * 1000)
+            return self.get_query().filter(within)
+        return super().build_query()
+
+    def build_mask(self, index: ListingIndex) -> np.ndarray:
+        if self.has_geodata_values():
+            within = index.within(self.state['provided_location']['latitude'],
+                                  self.state['provided_location']['longitude'],
+                                  self.get_provided_radius() * 1000)
+            return self.get_mask(index) & within
+        return super().build_mask(index)
+
+    async def fetch_count(self) -> int:
+        if self.has_geodata_values():
+            return await BaseFilter.fetch_count(self)
+        return await super().fetch_count()
 
     def has_values(self):
         button_values = super().has_values()
@@ -466,8 +623,9 @@ class RoomsFilter(BaseFilter):
             state: Optional[Dict],
             prev_filter: Optional["BaseFilter"] = None,
             name: Optional[str] = None,
+            facet_engine: Optional[FacetEngine] = None,
     ):
-        super().__init__(model, state, prev_filter, name)
+        super().__init__(model, state, prev_filter, name, facet_engine)
 
     async def build_text(self, is_final=False, is_active=False):
         items = await self.get_items()
@@ -484,8 +642,7 @@ class RoomsFilter(BaseFilter):
         for r_qty in range(1, self.MAX_ROOMS):
             if r_qty in rooms_qty:
                 items.append(str(r_qty))
-                rooms_qty.remove(r_qty)
-        if len(rooms_qty):
+        if any(r_qty >= self.MAX_ROOMS for r_qty in rooms_qty):
             items.append(f"{self.MAX_ROOMS}+")
 
         items = map(
@@ -496,30 +653,71 @@ class RoomsFilter(BaseFilter):
         )
         return list(items)
 
+    def get_facet_column(self) -> Optional[Column]:
+        return self.model.rooms
+
+    def get_item_key(self, rooms: int) -> str:
+        key = str(rooms) if rooms < self.MAX_ROOMS else f"{self.MAX_ROOMS}+"
+        return self.ROOM_BUTTONS_MAPPING.get(key, key)
+
+    async def get_item_counts(self) -> Dict[str, int]:
+        counts = defaultdict(int)
+        for rooms, count in (await self.get_facets()).items():
+            counts[self.get_item_key(rooms)] += count
+        return dict(counts)
+
+    async def fetch_count(self) -> int:
+        items = self.get_selected_rooms()
+        more_rooms = self.has_more_rooms_selected()
+        if not len(items) and not more_rooms:
+            return await self.get_query_count()
+        return sum(
+            count
+            for rooms, count in (await self.get_facets()).items()
+            if rooms in items or (more_rooms and rooms >= self.MAX_ROOMS)
+        )
+
     async def get_rooms_qty(self) -> List[int]:
-        return await get_unique_el_from_db(await self.get_query(), self.model.rooms)
+        return list(await self.get_facets())
 
-    @function_logger
-    async def build_query(self):
-        rooms_qty = await self.get_rooms_qty()
+    def get_selected_rooms(self) -> List[int]:
         items = []
         for r_qty in range(1, self.MAX_ROOMS):
             key = self.ROOM_BUTTONS_MAPPING.get(str(r_qty))
             if key and self.values[key]:
                 items.append(r_qty)
-            try:
-                rooms_qty.remove(r_qty)
-            except ValueError:
-                pass
+        return items
 
-        if self.values[f"3️⃣+"]:
-            items += rooms_qty
+    def has_more_rooms_selected(self) -> bool:
+        return self.values[self.ROOM_BUTTONS_MAPPING[f"{self.MAX_ROOMS}+"]]
 
-        query = await self.get_query()
+    @function_logger
+    def build_query(self):
+        conditions = []
+        items = self.get_selected_rooms()
         if len(items):
-            return query.filter(self.model.rooms.in_(items))
+            conditions.append(self.model.rooms.in_(items))
+        if self.has_more_rooms_selected():
+            conditions.append(self.model.rooms >= self.MAX_ROOMS)
+
+        query = self.get_query()
+        if len(conditions):
+            return query.filter(or_(*conditions))
         return query.filter()
 
+    def build_mask(self, index: ListingIndex) -> np.ndarray:
+        mask = self.get_mask(index)
+        items = self.get_selected_rooms()
+        more_rooms = self.has_more_rooms_selected()
+        if not len(items) and not more_rooms:
+            return mask
+
+        rooms = index.numbers[self.model.rooms.key]
+        selected = index.isin(self.model.rooms.key, items)
+        if more_rooms:
+            selected |= rooms >= self.MAX_ROOMS
+        return mask & selected
+
 
 class AdditionalFilter(BaseFilter):
     name = "Додаткові фільтри"
@@ -635,9 +833,8 @@ class AdditionalFilter(BaseFilter):
         active_item = active_items[page_idx]
         return active_item
 
-    #
-    @function_logger
-    async def build_query(self):
+    def get_allowed_values(self) -> Dict[str, List[str]]:
+        """Maps selected buttons to the kids/pets values a listing has to have"""
         pets_filter = []
         kids_filter = []
         for k, v in self.values.items():
@@ -645,15 +842,14 @@ class AdditionalFilter(BaseFilter):
                 kids_filter.append(k)
             if v and k in self.BUTTONS_MAPPING[PETS_FILTER_TEXT]["items"]:
                 pets_filter.append(k)
-        filters = []
-        conditions = []
+        allowed = {}
         all_kids_filters_selected = len(kids_filter) == len(
             self.BUTTONS_MAPPING[KIDS_FILTER_TEXT]["items"]
         )
         if len(kids_filter):
             if KIDS_ABOVE_SIX_YO_PROP in kids_filter and not all_kids_filters_selected:
                 kids_filter.append(ALL_KIDS_ALLOWED_PROP)
-            conditions.append(self.model.kids.in_(kids_filter))
+            allowed[self.model.kids.key] = kids_filter
         if len(pets_filter):
             if DOGS_ALLOWED_PROP in pets_filter or CATS_ALLOWED_PROP in pets_filter:
                 pets_filter.append(ALL_PETS_ALLOWED_PROP)
@@ -661,14 +857,31 @@ class AdditionalFilter(BaseFilter):
                 if ALL_PETS_ALLOWED_PROP not in pets_filter:
                     pets_filter.append(ALL_PETS_ALLOWED_PROP)
                 pets_filter.remove(OTHER_ANIMALS_PROP)
-            conditions.append(self.model.pets.in_(pets_filter))
+            allowed[self.model.pets.key] = pets_filter
+        return allowed
+
+    #
+    @function_logger
+    def build_query(self):
+        filters = []
+        conditions = [
+            getattr(self.model, key).in_(values) for key, values in self.get_allowed_values().items()
+        ]
         f = and_(*conditions)
         filters.append(f)
-        q = await self.get_query()
+        q = self.get_query()
         if not self.has_values():
             return q.filter()
         return q.filter(or_(*filters))
 
+    def build_mask(self, index: ListingIndex) -> np.ndarray:
+        mask = self.get_mask(index)
+        if not self.has_values():
+            return mask
+        for key, values in self.get_allowed_values().items():
+            mask = mask & index.isin(key, values)
+        return mask
+
     async def process_action(self, payload: Payload, update: Update, context: ContextTypes.DEFAULT_TYPE):
         items = self.get_active_subitems()
         for k in self.BUTTONS_MAPPING.keys():
@@ -727,32 +940,25 @@ class PriceFilter(BaseFilter):
         return True
 
     @function_logger
-    async def build_query(self):
-        q = await self.get_query()
+    def build_query(self):
+        q = self.get_query()
 
         if not self.has_values():
             return q.filter()
 
         price_from = self.values["price_to"] * 0.5
         price_to = self.values["price_to"] * 1.1
-        currencies = get_exchange_rates()
-
-        filters = []
-        for k, v in currencies.items():
-            conditions = [self.model.currency == k]
-
-            if price_from:
-                conditions.append(price_from / v <= self.model.rent_price)
-            if price_to:
-                conditions.append(self.model.rent_price <= (price_to / v))
 
-            f = and_(*conditions)
+        # One range over the price_uah index, rather than an OR of every currency
+        return q.filter(self.model.price_uah.between(price_from, price_to))
 
-            filters.append(f)
-
-        q = q.filter(or_(*filters))
+    def build_mask(self, index: ListingIndex) -> np.ndarray:
+        mask = self.get_mask(index)
+        if not self.has_values():
+            return mask
 
-        return q
+        price = index.price_uah
+        return mask & (self.values["price_to"] * 0.5 <= price) & (price <= self.values["price_to"] * 1.1)
 
 
 LIVING_AREAS = {
@@ -773,8 +979,8 @@ class LivingAreaFilter(BaseFilter):
         return living_areas
 
     @function_logger
-    async def build_query(self):
-        q = await self.get_query()
+    def build_query(self):
+        q = self.get_query()
         area_from = [0]
         area_to = [10000]
         for k, v in LIVING_AREAS.items():
@@ -790,3 +996,14 @@ class LivingAreaFilter(BaseFilter):
         )
         q = q.filter(stmt)
         return q
+
+    def build_mask(self, index: ListingIndex) -> np.ndarray:
+        area_from = [0]
+        area_to = [10000]
+        for k, v in LIVING_AREAS.items():
+            if self.values[k]:
+                area_from.append(v[0])
+                area_to.append(v[1])
+
+        living_area = index.numbers[self.model.living_area.key]
+        return self.get_mask(index) & (min(area_from) <= living_area) & (living_area <= max(area_to))
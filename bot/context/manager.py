@@ -1,24 +1,30 @@
 import datetime
 import json
 from json import JSONDecodeError
-from typing import Type, List, Tuple, Optional
+from typing import Any, Type, List, Tuple, Optional
 
 from sqlalchemy.ext.serializer import dumps
 from sqlalchemy.sql import Select
 from telegram import InlineKeyboardMarkup, Update, Message
 from telegram.ext import ContextTypes
 
+from bot.context.facets import FacetEngine
 from bot.context.filters import BaseFilter
 from bot.context.message_forwarder import MessageForwarder
 from bot.context.payload import Payload
+from bot.context.snapshots import ResultSnapshot, save_snapshot, get_snapshot, drop_snapshot
 from bot.context.state import State
 from bot.db import (
-    get_result,
+    get_result_page,
+    get_result_rows_by_ids,
+    has_result,
     save_user,
     delete_model_by_link,
     get_model_by_link, get_user,
+    make_point,
 )
 from bot.exceptions import MessageNotFound
+from bot.listing_index import get_listing_index, remove_link_from_indexes
 from bot.models import Ad
 from bot.navigation.basic_keyboard_builder import show_menu
 from bot.navigation.buttons_constants import (
@@ -34,6 +40,7 @@ from bot.navigation.buttons_constants import (
 from bot.navigation.constants import (
     SHOW_ITEMS_PER_PAGE,
     EMPTY_RESULT_TEXT,
+    FOUND_ITEMS_TEXT,
     THATS_ALL_FOLKS_TEXT,
     LOAD_MORE_LINKS_TEXT, SUBSCRIBE_USER_TEXT, )
 from bot.notifications import notify_admins
@@ -60,6 +67,7 @@ class Manager:
         self.filters = []
         self.forwarder = forwarder
         self.model = model
+        self.facet_engine = FacetEngine()
 
         prev_filter = None
         for i in range(len(filters)):
@@ -67,7 +75,7 @@ class Manager:
             if i >= len(self.state.filters):
                 self.state.filters.append(None)
             s = self.state.filters[i]
-            filter_obj = f(state=s, prev_filter=prev_filter, model=model)
+            filter_obj = f(state=s, prev_filter=prev_filter, model=model, facet_engine=self.facet_engine)
             prev_filter = filter_obj
             self.filters.append(filter_obj)
 
@@ -177,6 +185,7 @@ class Manager:
 
     async def reset_state(self):
         self.state.result_sliced_view = None
+        self.state.result_cursor = None
         self.state.filters = []
         self.state.filter_index = 0
         self.save_state()
@@ -191,11 +200,13 @@ class Manager:
                 and self.state.result_sliced_view is not None
         ):
             self.state.result_sliced_view = None
+            self.state.result_cursor = None
             return
         self.state.filter_index -= 1
 
     async def edit_message(self, outer_text=None):
-        kbrd = await self.active_filter.build_keyboard()
+        await self.facet_engine.prefetch(self.filters[:self.state.filter_index + 1])
+        kbrd = await self.active_filter.render_keyboard()
         navigation_row = []
         back_btn = self.active_filter.build_back_btn()
         next_btn = self.active_filter.build_next_btn()
@@ -213,7 +224,9 @@ class Manager:
         for i in range(self.state.filter_index + 1):
             f = self.filters[i]
             is_active = i == self.state.filter_index
-            text.append(await f.build_text(is_active=is_active))
+            text.append(await f.render_text(is_active=is_active))
+        if not self.state.is_subscription:
+            text.append(FOUND_ITEMS_TEXT.format(await self.active_filter.get_count()))
         text = list(filter(None, text))
         keyboard = InlineKeyboardMarkup(kbrd)
         callback_query = self.update.callback_query
@@ -261,35 +274,99 @@ class Manager:
                 print(e.message_link)
                 await self.notify_admins_about_bad_link(e.message_link)
                 await delete_model_by_link(self.model, e.message_link)
+                remove_link_from_indexes(e.message_link)
+
+    def get_location(self) -> Optional[Tuple[float, float]]:
+        """Location of a geo search, its results are shown nearest first"""
+        return self.active_filter.get_location()
+
+    def get_point(self):
+        location = self.get_location()
+        return make_point(*location) if location is not None else None
+
+    def get_result_cursor(self) -> Optional[Tuple[Any, int]]:
+        """(created_at, id) of the last shown result, or (distance, id) in geo search"""
+        if self.state.result_cursor is None:
+            return None
+        key, id_ = self.state.result_cursor
+        if self.get_location() is None:
+            key = datetime.datetime.fromisoformat(key)
+        return key, id_
+
+    def set_result_cursor(self, key, id_: int):
+        if isinstance(key, datetime.datetime):
+            key = key.isoformat()
+        self.state.result_cursor = [key, id_]
+
+    async def get_result_page(self, after: Optional[Tuple[Any, int]]):
+        """Next page of results plus one row, to know if there is anything after it"""
+        index = get_listing_index(self.model)
+        if index is not None:
+            return index.page(self.active_filter.build_mask(index), SHOW_ITEMS_PER_PAGE + 1, after,
+                              self.get_location())
+        return await get_result_page(self.active_filter.build_query(), SHOW_ITEMS_PER_PAGE + 1, after,
+                                     self.get_point())
 
     async def empty_result(self):
-        q = await self.active_filter.build_query()
-        all_items_result = await get_result(q, self.model)
-        empty_result = not len(all_items_result)
-        return empty_result
+        index = get_listing_index(self.model)
+        if index is not None:
+            return not index.any(self.active_filter.build_mask(index))
+        return not await has_result(self.active_filter.build_query())
+
+    def get_snapshot_key(self) -> str:
+        return json.dumps([self.state.filter_index, self.state.filters], sort_keys=True)
+
+    async def take_snapshot(self) -> Optional[ResultSnapshot]:
+        """
+        Ids of the whole result, only from the listing index.
+        Postgres would have to read all of them, pages come from the keyset cursor then.
+        """
+        index = get_listing_index(self.model)
+        if index is None:
+            # A snapshot of an earlier search with the same filters would mix with these pages
+            drop_snapshot(self.update.effective_user.id)
+            return None
+        ids = index.ids_for(self.active_filter.build_mask(index), self.get_location()).tolist()
+        return save_snapshot(self.update.effective_user.id, self.model, self.get_snapshot_key(), ids)
+
+    async def get_rows_by_ids(self, ids: List[int]):
+        index = get_listing_index(self.model)
+        if index is not None:
+            return index.rows_by_ids(ids, self.get_location())
+        return await get_result_rows_by_ids(self.model, ids, self.get_point())
+
+    async def get_page(self) -> Tuple[list, bool]:
+        """
+        Rows of the next page of results and whether anything is left after it.
+        The first page snapshots the whole result, so syncs in between don't shift later pages.
+        Without a snapshot (cold index or expired), pages continue from the keyset cursor.
+        """
+        offset = self.state.result_sliced_view or 0
+        if self.state.result_sliced_view is None:
+            snapshot = await self.take_snapshot()
+        else:
+            snapshot = get_snapshot(self.update.effective_user.id, self.model, self.get_snapshot_key())
+
+        if snapshot is not None:
+            rows = await self.get_rows_by_ids(snapshot.ids[offset: offset + SHOW_ITEMS_PER_PAGE].tolist())
+            return rows, offset + SHOW_ITEMS_PER_PAGE < len(snapshot.ids)
+
+        page = await self.get_result_page(self.get_result_cursor())
+        return page[:SHOW_ITEMS_PER_PAGE], len(page) > SHOW_ITEMS_PER_PAGE
 
     async def _show_result(self, just_subscribed):
-        await get_user(self.update.effective_user.id)
-        q = await self.active_filter.build_query()
-        all_items_result = await get_result(q, self.model)
-        #todo:rewrite
-        all_items_result_len = len(all_items_result)
-        has_pagination = all_items_result_len > SHOW_ITEMS_PER_PAGE
-        empty_result = not all_items_result_len
+        page, has_next_page = await self.get_page()
+        items_result = [link for link, _, _ in page]
+        last_page = not has_next_page
+        empty_result = self.state.result_sliced_view is None and not len(page) and last_page
         keyboard = []
-        page_offset = self.state.result_sliced_view or 0
-        items_result = all_items_result[
-                       page_offset: (page_offset + SHOW_ITEMS_PER_PAGE)
-                       ]
-        last_page = len(items_result) < SHOW_ITEMS_PER_PAGE
         user = await get_user(self.update.effective_user.id)
 
         subscription_text = await self.build_subscription_text()
         is_same_subscription = user.subscription_text == subscription_text
 
         text = ""
-        if has_pagination and not last_page:
-            page_offset += SHOW_ITEMS_PER_PAGE
+        if not last_page:
             text = LOAD_MORE_LINKS_TEXT
             keyboard.append(NEXT_PAGE_BTN)
 
@@ -298,7 +375,7 @@ class Manager:
             keyboard.append([SUBSCRIPTION_BTN])
         reply_markup = InlineKeyboardMarkup(keyboard)
 
-        if await self.empty_result():
+        if empty_result:
             text = EMPTY_RESULT_TEXT
         if just_subscribed:
             text += f'\nВи підписалися на оновлення за цими критеріями ✅'
@@ -319,7 +396,10 @@ class Manager:
             chat_id=self.update.effective_chat.id, text=text, reply_markup=reply_markup
         )
 
-        self.state.result_sliced_view = page_offset
+        if len(page):
+            _, key, id_ = page[-1]
+            self.set_result_cursor(key, id_)
+        self.state.result_sliced_view = (self.state.result_sliced_view or 0) + SHOW_ITEMS_PER_PAGE
         self.save_state()
 
     def save_state(self):
@@ -329,14 +409,14 @@ class Manager:
         text = ["Ви будете проінформовані про нові оголошення за такими критеріями:\n"]
         for i in range(self.state.filter_index + 1):
             f = self.filters[i]
-            text.append(await f.build_text(is_final=True, is_active=False))
+            text.append(await f.render_text(is_final=True, is_active=False))
         return "\n".join(text)
 
     async def create_subscription(self, user_id=None):
         if user_id is None:
             user_id = self.update.effective_user.id
         user = await get_user(user_id)
-        query = await self.active_filter.build_query()
+        query = self.active_filter.build_query()
         serialized = dumps(query)
         user.subscription = serialized
         user.subscription_text = await self.build_subscription_text()
@@ -0,0 +1,22 @@
+from typing import Any, Awaitable, Callable, Hashable
+
+from bot.cache import VersionedLRUCache
+from bot.db import get_data_version
+
+RENDER_CACHE_SIZE = 4096
+
+render_cache = VersionedLRUCache(maxsize=RENDER_CACHE_SIZE)
+
+
+async def get_or_render(key: Hashable, render: Callable[[], Awaitable[Any]]) -> Any:
+    """Returns what render() built for the same key and data version, rendering only on a miss"""
+    version = get_data_version()
+    value = render_cache.get(key, version)
+    if value is None:
+        value = await render()
+        render_cache.set(key, version, value)
+    return value
+
+
+def get_render_cache_stats() -> dict:
+    return render_cache.stats()
@@ -0,0 +1,51 @@
+from array import array
+from dataclasses import dataclass
+from typing import Iterable, Optional, Type
+
+from cachetools import TTLCache
+
+from bot.models import Ad
+
+SNAPSHOTS_MAXSIZE = 5000
+SNAPSHOT_TTL = 60 * 60
+
+
+@dataclass
+class ResultSnapshot:
+    """Ordered ids of a search result, as they were when the first page was shown"""
+
+    model_name: str
+    # State of the filter chain the result is for
+    filters_key: str
+    ids: array
+
+
+_snapshots = TTLCache(maxsize=SNAPSHOTS_MAXSIZE, ttl=SNAPSHOT_TTL)
+
+
+def save_snapshot(
+    user_id: int, model: Type[Ad], filters_key: str, ids: Iterable[int]
+) -> ResultSnapshot:
+    """One snapshot per user, a new search replaces the previous one"""
+    snapshot = ResultSnapshot(
+        model_name=model.__tablename__, filters_key=filters_key, ids=array("q", ids)
+    )
+    _snapshots[user_id] = snapshot
+    return snapshot
+
+
+def drop_snapshot(user_id: int):
+    _snapshots.pop(user_id, None)
+
+
+def get_snapshot(
+    user_id: int, model: Type[Ad], filters_key: str
+) -> Optional[ResultSnapshot]:
+    """:return: None unless the user's snapshot is of the same search"""
+    snapshot = _snapshots.get(user_id)
+    if snapshot is None or (snapshot.model_name, snapshot.filters_key) != (
+        model.__tablename__,
+        filters_key,
+    ):
+        return None
+    return snapshot
@@ -11,8 +11,10 @@ class State:
         filters=None,
         is_subscription=False,
         subscribe_user=False,
+        result_cursor=None,
     ):
         self.result_sliced_view = result_sliced_view
+        self.result_cursor = result_cursor
         self.filter_index = filter_index
         self.filters = filters if filters is not None else []
         self.is_subscription = is_subscription
@@ -22,6 +24,7 @@ class State:
         return json.dumps(
             {
                 "rsv": self.result_sliced_view,
+                "rc": self.result_cursor,
                 "i": self.filter_index,
                 "f": self.filters,
                 "sbcsr_mode": self.is_subscription,
@@ -35,6 +38,7 @@ class State:
 
         return cls(
             result_sliced_view=data.get("rsv"),
+            result_cursor=data.get("rc"),
             filter_index=data.get("i") or 0,
             filters=data.get("f") or [],
             is_subscription=data.get("sbcsr_mode"),
@@ -1,15 +1,23 @@
 import asyncio
+import hashlib
+import json
+from typing import Dict, Optional, Iterator, AsyncIterator, List
 
+from googleapiclient.errors import HttpError
 from pyrogram.errors import FloodWait
 
 import bot
-from bot.api.google import GoogleApi
+from bot.api.google import GoogleApi, run_google_call, is_range_error
+from bot.api.monobank_currency import get_exchange_rates
+from bot.config import RENT_SPREADSHEET_ID
 from bot.context.message_forwarder import MessageForwarder
 from bot.db import (
-    sync_objects_to_db,
+    sync_object_chunks_to_db,
+    get_content_hash,
     get_users_with_subscription,
     get_user_subscription,
 )
+from bot.listing_index import rebuild_listing_index
 from bot.log import logging
 from bot.models import Apartments
 
@@ -33,6 +41,7 @@ PROP_IS_CLOSED = "is_closed"
 PROP_KIDS = "kids"
 PROP_PETS = "pets"
 PROP_GEO = "maps_link"
+PROP_CONTENT_HASH = "content_hash"
 
 KIDS_FILTER_TEXT = "В мене є діти"
 PETS_FILTER_TEXT = "В мене є тварини"
@@ -92,6 +101,8 @@ VALIDATORS = {
     PROP_LINK: validate_link,
     PROP_KIDS: validate_additional_filters,
     PROP_PETS: validate_additional_filters,
+    # A cleared cell and a missing trailing cell both mean no link
+    PROP_GEO: lambda v: v or None,
 }
 
 MAPPING_APARTS = {
@@ -123,44 +134,157 @@ MAPPING_HOUSES = {
 }
 
 
+# Cells a listing may leave empty, a row that ends before any other mapped column is truncated
+OPTIONAL_PROPS = {PROP_IS_CLOSED, PROP_KIDS, PROP_PETS, PROP_GEO}
+
+SHEETS = {
+    CAT_APARTMENTS: (bot.models.Apartments, MAPPING_APARTS),
+    CAT_HOUSES: (bot.models.Houses, MAPPING_HOUSES),
+}
+
+# Sheet rows per request, also rows per write to the database
+SHEET_PAGE_SIZE = 1000
+# Pages fetched ahead of the database writes
+PIPELINE_DEPTH = 2
+
+# What the last sync saw, a sync of an unchanged spreadsheet stops after one Drive request
+_last_revision: Optional[str] = None
+_last_values_hashes: Dict[str, str] = {}
+
+
+async def iter_queue(queue: asyncio.Queue) -> AsyncIterator:
+    """Items of the queue until None"""
+    while (item := await queue.get()) is not None:
+        yield item
+
+
+def log_sync_result(category: str, result: dict):
+    logging.info(
+        "%s synced: %s inserted, %s updated, %s deleted",
+        category, result["inserted"], result["updated"], result["deleted"],
+    )
+    for change in result["changes"]:
+        logging.info("%s %s changed: %s", category, change["link"], ", ".join(change["fields"]))
+
+
 class DataManager:
     def __init__(self):
-        self.api = GoogleApi()
+        self.api: Optional[GoogleApi] = None
 
-    async def sync_data(self):
-        await self.sync_apartments()
-        await self.sync_houses()
+    async def get_api(self) -> GoogleApi:
+        # Credentials may be refreshed over the network on creation
+        if self.api is None:
+            self.api = await run_google_call(GoogleApi)
+        return self.api
 
-        logging.info("Done")
-
-    def get_sheet_data(self, sheet_name, mapping):
+    async def sync_data(self, force: bool = False) -> bool:
         """
-        :param sheet_name: str
-        :param mapping: Dict
-        :return: List[Dict]
+        :param force: sync even if the spreadsheet wasn't edited since the last sync
+        :return: whether listings were synced
         """
-        data = self.api.get_sheet_data(sheet_name)
-
-        header = data[0]
-        header_len = len(header)
+        global _last_revision
+        api = await self.get_api()
+        revision = await run_google_call(api.get_spreadsheet_revision, RENT_SPREADSHEET_ID)
+        if not force and revision == _last_revision:
+            logging.info("Spreadsheet revision %s is synced already", revision)
+            return False
+
+        # Pages are written to the database while the next ones are downloaded
+        queues = {CATEGORIES[category]: asyncio.Queue(maxsize=PIPELINE_DEPTH) for category in SHEETS}
+        columns = {CATEGORIES[category]: mapping.keys() for category, (_, mapping) in SHEETS.items()}
+        fetcher = asyncio.create_task(self.fetch_pages(api, columns, queues))
+        writers = [
+            asyncio.create_task(self.sync_sheet(category, model, mapping, queues[CATEGORIES[category]], force))
+            for category, (model, mapping) in SHEETS.items()
+        ]
+        try:
+            _, *results = await asyncio.gather(fetcher, *writers)
+        except BaseException:
+            # Writers of a failed sync roll back, the fetcher stops
+            for task in (fetcher, *writers):
+                task.cancel()
+            raise
+        synced = any(results)
+        _last_revision = revision
 
-        mapping_len = len(mapping)
+        logging.info("Done")
+        return synced
 
+    @staticmethod
+    async def fetch_pages(api: GoogleApi, columns: Dict[str, list], queues: Dict[str, asyncio.Queue]):
+        """
+        Puts pages of SHEET_PAGE_SIZE rows of every sheet to its queue, the first page starts with the header.
+        Sheets are fetched in one request per page, None is put after the last page of a sheet.
+        A sheet ends at the last row of its grid, blank pages before it may be followed by more listings.
+        """
+        row_counts = await run_google_call(api.get_sheet_row_counts)
+        missing = set(columns) - set(row_counts)
+        if missing:
+            raise Exception(f"Missing sheets: {missing}")
+
+        columns = dict(columns)
+        first_row = 1
+        while columns:
+            # The last page of a sheet stops at its grid, ranges past it are rejected
+            requests = {}
+            for sheet_name, names in columns.items():
+                last_row = min(first_row + SHEET_PAGE_SIZE - 1, row_counts[sheet_name])
+                requests.setdefault(last_row, {})[sheet_name] = names
+            for last_row, sheet_columns in requests.items():
+                pages = await DataManager.fetch_page(api, sheet_columns, first_row, last_row)
+                for sheet_name, rows in pages.items():
+                    if rows is None and first_row == 1:
+                        raise Exception(f"Sheet {sheet_name} is empty")
+                    if rows is not None:
+                        await queues[sheet_name].put(rows)
+                    if rows is None or last_row >= row_counts[sheet_name]:
+                        del columns[sheet_name]
+                        await queues[sheet_name].put(None)
+            first_row += SHEET_PAGE_SIZE
+
+    @staticmethod
+    async def fetch_page(api: GoogleApi, columns: Dict[str, list], first_row: int, last_row: int) -> Dict[str, Optional[list]]:
+        """:return: {sheet name: rows}, None for sheets that were shortened past first_row since their size was read"""
+        try:
+            return await run_google_call(api.get_sheets_rows, columns, first_row, last_row)
+        except HttpError as e:
+            if not is_range_error(e):
+                raise
+        if len(columns) == 1:
+            return dict.fromkeys(columns)
+        # One range past its grid fails the whole batch, so the sheets are retried one by one
+        pages = {}
+        for sheet_name, names in columns.items():
+            pages.update(await DataManager.fetch_page(api, {sheet_name: names}, first_row, last_row))
+        return pages
+
+    @staticmethod
+    def check_header(header: list, mapping):
         diff = set(mapping.keys()) - set(header)
 
         if diff:
             raise Exception(f"Missing columns: {diff}")
 
-        data = data[1:]
+    def iter_sheet_rows(self, header, data, mapping) -> Iterator[dict]:
+        """
+        :param header: List column names of the rows
+        :param data: List[List] sheet rows without the header
+        :param mapping: Dict
+        :return: valid rows as dicts of listing attributes
+        """
+        header_len = len(header)
+
+        required_len = max(
+            (i + 1 for i, name in enumerate(header) if name in mapping and mapping[name] not in OPTIONAL_PROPS),
+            default=0,
+        )
 
-        result = []
         for datum in data:
             datum_len = len(datum)
-            if datum_len < mapping_len:
+            if not datum_len or datum_len < required_len:
                 logging.warning("Skipped row: %s", datum)
                 continue
 
-            print(datum)
             result_row = {}
             for col_idx in range(header_len):
                 original_header_name = header[col_idx]
@@ -186,19 +310,36 @@ class DataManager:
                 if value is not None:
                     result_row[attr_name] = value
             else:
-                result.append(result_row)
-
-        return result
-
-    async def sync_apartments(self):
-        data = self.get_sheet_data(CATEGORIES[CAT_APARTMENTS], MAPPING_APARTS)
-
-        await sync_objects_to_db(bot.models.Apartments, data)
-
-    async def sync_houses(self):
-        data = self.get_sheet_data(CATEGORIES[CAT_HOUSES], MAPPING_HOUSES)
-
-        await sync_objects_to_db(bot.models.Houses, data)
+                result_row[PROP_CONTENT_HASH] = get_content_hash(result_row)
+                yield result_row
+
+    async def sync_sheet(self, category: str, model, mapping, pages: asyncio.Queue, force: bool) -> bool:
+        """:return: False if the sheet values are the same as on the last sync"""
+        sheet_name = CATEGORIES[category]
+        values_hash = hashlib.blake2b(digest_size=16)
+
+        async def iter_chunks() -> AsyncIterator[List[dict]]:
+            header = None
+            async for rows in iter_queue(pages):
+                values_hash.update(json.dumps(rows, ensure_ascii=False).encode())
+                if header is None:
+                    header, rows = (rows[0], rows[1:]) if rows else ([], [])
+                    self.check_header(header, mapping)
+                yield list(self.iter_sheet_rows(header, rows, mapping))
+
+        def is_changed() -> bool:
+            # Formatting and other edits change the revision but not the values
+            return force or _last_values_hashes.get(sheet_name) != values_hash.hexdigest()
+
+        result = await sync_object_chunks_to_db(model, iter_chunks(), get_exchange_rates(), is_changed)
+        if result is None:
+            logging.info("Sheet %s values are synced already", sheet_name)
+            return False
+
+        log_sync_result(category, result)
+        await rebuild_listing_index(model)
+        _last_values_hashes[sheet_name] = values_hash.hexdigest()
+        return True
 
     async def notify_users(self, forwarder: MessageForwarder):
         users = await get_users_with_subscription()
@@ -1,84 +1,361 @@
 import datetime
+import hashlib
+import json
 from dataclasses import dataclass
-from typing import Dict, List, Type, Optional
+from typing import Any, AsyncIterable, Callable, Dict, List, Type, Optional, Tuple
 
-from sqlalchemy import or_, and_, not_
-from sqlalchemy import select, column, Column, delete, desc, Integer, func
+from sqlalchemy import or_, and_, not_, case, null, String
+from sqlalchemy import select, Column, delete, update, desc, Integer, Float, Boolean, func, tuple_, lambda_stmt, cast
+from sqlalchemy import DateTime, MetaData, Table, exists, literal, literal_column
+from sqlalchemy.dialects.postgresql import insert, array, ARRAY
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.serializer import loads
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import Select
+from sqlalchemy.sql import Select, ColumnElement
+from sqlalchemy.sql.functions import Function
 from telegram import Update
 
 import bot.models
+from bot.cache import VersionedLRUCache
 from bot.config import DB_URI
 
-engine = create_async_engine(DB_URI)
+# Compiled SQL is cached per statement shape, only bound parameters differ between users.
+# asyncpg then prepares every distinct SQL string once per connection.
+QUERY_CACHE_SIZE = 1200
+PREPARED_STATEMENT_CACHE_SIZE = 500
+
+engine = create_async_engine(
+    DB_URI,
+    query_cache_size=QUERY_CACHE_SIZE,
+    connect_args={"prepared_statement_cache_size": PREPARED_STATEMENT_CACHE_SIZE},
+)
 async_session = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
 
+FACETS_CACHE_SIZE = 2048
+# Rows per multi-row INSERT, keeps statements far from the limit of bind parameters
+GEODATA_BATCH_SIZE = 1000
+
+# Bumped on every write to listings or geodata, tags cached query results
+data_version = 0
+facets_cache = VersionedLRUCache(maxsize=FACETS_CACHE_SIZE)
+
+
+def bump_data_version():
+    global data_version
+    data_version += 1
+
+
+def get_data_version() -> int:
+    return data_version
+
+
+def get_facets_cache_stats() -> dict:
+    return facets_cache.stats()
+
 
 async def remove_data_from_db(model_name):
     async with async_session() as session:
         await session.execute(model_name.__table__.delete())
         await session.commit()
+    bump_data_version()
+
+
+def get_content_hash(row: Dict[str, Any]) -> str:
+    """Digest of the sheet values of a listing, stable across runs and key order"""
+    payload = json.dumps(row, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
 
 
-def is_data_new_for_instance(data: Dict[str, str], instance: bot.models.Ad):
-    for k, v in data.items():
-        if v != getattr(instance, k):
-            return True
-    return False
-
-
-async def sync_objects_to_db(model: Type[bot.models.Ad], data: List[Dict[str, str]]):
-    # todo: it could be admin alert
-    # seen = set()
-    # not_uniq = []
-    # for datum in data:
-    #     if datum["id"] not in seen:
-    #         seen.add(datum["id"])
-    #     else:
-    #         not_uniq.append(datum["id"])
-    #
-    # print(not_uniq)
+def get_changed_fields(data: Dict[str, Any], instance: bot.models.Ad) -> List[str]:
+    return [k for k, v in data.items() if v != getattr(instance, k)]
+
+
+# Filled by sync from the spreadsheet, the rest of listing columns are derived or timestamps
+SYNC_DERIVED_COLUMNS = {"created_at", "updated_at", "coordinates", "price_uah"}
+# Sheet columns that aren't listing fields, a new value alone doesn't make a listing changed
+SYNC_KEY_COLUMNS = {"id", "link", "content_hash"}
+
+
+def get_sheet_columns(model: Type[bot.models.Ad]) -> List[Column]:
+    return [c for c in model.__table__.columns if c.name not in SYNC_DERIVED_COLUMNS]
+
+
+async def sync_objects_to_db(
+        model: Type[bot.models.Ad], data: List[Dict[str, str]], rates: Dict[str, Optional[float]]
+) -> Dict[str, Any]:
+    """
+    Makes the table mirror the spreadsheet rows: new links are inserted, changed rows get a new created_at,
+    rows missing from the sheet are deleted. Rows with the stored content_hash are skipped.
+    :return: {'inserted': int, 'updated': int, 'deleted': int,
+              'changes': [{'id': int, 'link': str, 'fields': [str]}] of the updated listings}
+    """
     updated_date = datetime.datetime.utcnow()
     async with async_session() as session:
-        max_id = (await session.execute(func.max(model.id))).scalar() or 0
-        for datum in data:
-            result = (await session.execute(select(model).where(model.link == datum["link"])))
-            instances = result.fetchone()
-            if instances is None:
-                existing_row = await session.get(model, datum['id'])
-                if existing_row is not None:
-                    max_id += 1
-                    datum['id'] = max_id
-                else:
-                    max_id = max(max_id, datum['id'])
-                instance = model(**datum)
-                instance.updated_at = updated_date
-            else:
-                instance = instances[0]
-                del datum["id"]
-                if is_data_new_for_instance(datum, instance):
-                    for k, v in datum.items():
-                        setattr(instance, k, v)
-                    instance.created_at = updated_date
-                instance.updated_at = updated_date
-            session.add(instance)
+        if engine.dialect.driver == "asyncpg":
+            counts = await bulk_upsert_objects(session, model, data, updated_date)
+        else:
+            counts = await upsert_objects_one_by_one(session, model, data, updated_date)
 
+        await resolve_coordinates(session, model)
+        await update_normalized_prices(session, model, rates)
         await session.commit()
+    bump_data_version()
+    return counts
+
+
+async def sync_object_chunks_to_db(
+        model: Type[bot.models.Ad],
+        chunks: AsyncIterable[List[Dict[str, Any]]],
+        rates: Dict[str, Optional[float]],
+        should_apply: Callable[[], bool] = lambda: True,
+) -> Optional[Dict[str, Any]]:
+    """
+    sync_objects_to_db for rows parsed on the fly, every chunk is copied to the staging table as soon as
+    it arrives and the table is reconciled once the last one did.
+    :param should_apply: asked after the last chunk, False discards the staged rows
+    :return: sync_objects_to_db result, None if discarded
+    """
+    if engine.dialect.driver != "asyncpg":
+        data = [datum async for chunk in chunks for datum in chunk]
+        return await sync_objects_to_db(model, data, rates) if should_apply() else None
 
-        delete_stmt = delete(model).where(
-            or_(model.updated_at < updated_date, model.updated_at.is_(None))
-        )
-        await session.execute(delete_stmt)
+    updated_date = datetime.datetime.utcnow()
+    async with async_session() as session:
+        staging = await create_staging_table(session, model)
+        pos = 0
+        async for chunk in chunks:
+            await copy_to_staging(session, staging, chunk, pos)
+            pos += len(chunk)
+        if not should_apply():
+            await session.rollback()
+            return None
+
+        counts = await reconcile_staging(session, model, staging, updated_date)
+        await resolve_coordinates(session, model)
+        await update_normalized_prices(session, model, rates)
+        await session.commit()
+    bump_data_version()
+    return counts
+
+
+async def bulk_upsert_objects(
+        session: AsyncSession, model: Type[bot.models.Ad], data: List[Dict[str, str]], updated_date: datetime.datetime
+) -> Dict[str, Any]:
+    """
+    COPYs the rows into a temporary staging table and reconciles the table with it in a few statements,
+    the number of round trips doesn't depend on the number of rows
+    """
+    staging = await create_staging_table(session, model)
+    await copy_to_staging(session, staging, data)
+    return await reconcile_staging(session, model, staging, updated_date)
+
+
+async def create_staging_table(session: AsyncSession, model: Type[bot.models.Ad]) -> Table:
+    """Temporary table for sheet rows, dropped with the end of the transaction"""
+    staging = Table(
+        f"{model.__tablename__}_staging", MetaData(),
+        *[Column(c.name, c.type) for c in get_sheet_columns(model)],
+        # Sheet order, the first of rows with the same id keeps it
+        Column("pos", Integer),
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP",
+    )
+    connection = await session.connection()
+    await connection.run_sync(staging.create)
+    return staging
+
+
+async def copy_to_staging(session: AsyncSession, staging: Table, data: List[Dict[str, Any]], first_pos: int = 0):
+    names = [c.name for c in staging.columns if c.name != "pos"]
+    connection = await session.connection()
+    raw_connection = await connection.get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        staging.name,
+        records=[tuple(datum.get(name) for name in names) + (pos,) for pos, datum in enumerate(data, first_pos)],
+        columns=names + ["pos"],
+    )
+
+
+async def reconcile_staging(
+        session: AsyncSession, model: Type[bot.models.Ad], staging: Table, updated_date: datetime.datetime
+) -> Dict[str, Any]:
+    table = model.__table__
+    names = [c.name for c in get_sheet_columns(model)]
+
+    # Links are unique, the last row with a link wins as it did when rows were written one by one
+    later_rows = staging.alias("later_rows")
+    await session.execute(delete(staging).where(
+        exists().where(and_(later_rows.c.link == staging.c.link, later_rows.c.pos > staging.c.pos))
+    ))
+
+    # New listings whose id is taken by another listing get ids above the current maximum
+    new_rows = select(staging.c.pos, staging.c.id) \
+        .where(~exists().where(table.c.link == staging.c.link)) \
+        .cte("new_rows")
+    earlier_rows = new_rows.alias("earlier_rows")
+    colliding = select(new_rows.c.pos, func.row_number().over(order_by=new_rows.c.pos).label("n")) \
+        .where(or_(
+            new_rows.c.id.is_(None),
+            exists().where(table.c.id == new_rows.c.id),
+            exists().where(and_(earlier_rows.c.id == new_rows.c.id, earlier_rows.c.pos < new_rows.c.pos)),
+        )) \
+        .cte("colliding")
+    max_id = func.coalesce(
+        func.greatest(select(func.max(table.c.id)).scalar_subquery(), select(func.max(staging.c.id)).scalar_subquery()),
+        0,
+    )
+    await session.execute(
+        update(staging).where(staging.c.pos == colliding.c.pos).values(id=max_id + colliding.c.n)
+    )
+
+    fields = [name for name in names if name not in SYNC_KEY_COLUMNS]
+    # Cells left empty in the sheet keep the stored value
+    new_values = {name: func.coalesce(staging.c[name], table.c[name]) for name in fields}
+    changed_fields = func.array_remove(
+        array([case((value.is_distinct_from(table.c[name]), literal(name, String))) for name, value in new_values.items()]),
+        null(),
+        type_=ARRAY(String),
+    )
+    # Only rows with a new hash are compared field by field
+    changes_stmt = select(table.c.id, table.c.link, changed_fields.label("fields")) \
+        .join_from(staging, table, table.c.link == staging.c.link) \
+        .where(table.c.content_hash.is_distinct_from(staging.c.content_hash))
+    changes = [
+        {"id": row.id, "link": row.link, "fields": row.fields}
+        for row in await session.execute(changes_stmt)
+        if row.fields
+    ]
+
+    stmt = insert(table).from_select(
+        names + ["created_at", "updated_at"],
+        select(
+            *[staging.c[name] for name in names],
+            # Typed, a bare parameter in a select list is text for Postgres
+            cast(literal(updated_date), DateTime),
+            cast(literal(updated_date), DateTime),
+        ).order_by(staging.c.pos),
+    )
+    values = {name: func.coalesce(stmt.excluded[name], table.c[name]) for name in fields}
+    is_changed = or_(*[value.is_distinct_from(table.c[name]) for name, value in values.items()])
+    upserted = stmt.on_conflict_do_update(
+        index_elements=[table.c.link],
+        set_={
+            **values,
+            "content_hash": stmt.excluded.content_hash,
+            # A new hash with the same fields, e.g. a cell cleared, doesn't alert subscribers again
+            "created_at": case((is_changed, stmt.excluded.created_at), else_=table.c.created_at),
+            "updated_at": stmt.excluded.updated_at,
+        },
+        where=table.c.content_hash.is_distinct_from(stmt.excluded.content_hash),
+    ).returning(literal_column("xmax = 0", Boolean).label("inserted")).cte("upserted")
+    inserted = (await session.execute(select(func.count().filter(upserted.c.inserted)))).scalar()
+
+    result = await session.execute(delete(table).where(~exists().where(staging.c.link == table.c.link)))
+    return {"inserted": inserted, "updated": len(changes), "deleted": result.rowcount, "changes": changes}
+
+
+async def upsert_objects_one_by_one(
+        session: AsyncSession, model: Type[bot.models.Ad], data: List[Dict[str, str]], updated_date: datetime.datetime
+) -> Dict[str, Any]:
+    """Dialects without COPY"""
+    counts = {"inserted": 0, "updated": 0, "deleted": 0, "changes": []}
+    max_id = (await session.execute(func.max(model.id))).scalar() or 0
+    for datum in data:
+        result = (await session.execute(select(model).where(model.link == datum["link"])))
+        instances = result.fetchone()
+        if instances is None:
+            existing_row = await session.get(model, datum['id'])
+            if existing_row is not None:
+                max_id += 1
+                datum['id'] = max_id
+            else:
+                max_id = max(max_id, datum['id'])
+            instance = model(**datum)
+            instance.updated_at = updated_date
+            counts["inserted"] += 1
+        else:
+            instance = instances[0]
+            del datum["id"]
+            if datum.get("content_hash") != instance.content_hash:
+                fields = get_changed_fields({k: v for k, v in datum.items() if k not in SYNC_KEY_COLUMNS}, instance)
+                for k, v in datum.items():
+                    setattr(instance, k, v)
+                if fields:
+                    instance.created_at = updated_date
+                    counts["changes"].append({"id": instance.id, "link": instance.link, "fields": fields})
+            instance.updated_at = updated_date
+        session.add(instance)
+
+    await session.commit()
+
+    delete_stmt = delete(model).where(
+        or_(model.updated_at < updated_date, model.updated_at.is_(None))
+    )
+    result = await session.execute(delete_stmt)
+    counts["deleted"] = result.rowcount
+    counts["updated"] = len(counts["changes"])
+    return counts
+
+
+async def update_normalized_prices(
+        session: AsyncSession, model: Type[bot.models.Ad], rates: Dict[str, Optional[float]]
+):
+    """
+    Recomputes price_uah of all listings in one UPDATE, only rows whose price differs are written.
+    Listings in currencies without a known rate keep their price_uah until the rate is loaded.
+    """
+    # Casts keep Postgres from inferring the type of CASE from untyped parameters
+    rates = {currency: cast(rate, Float) for currency, rate in rates.items() if rate}
+    if not rates:
+        return
+    price_uah = model.rent_price * case(rates, value=model.currency)
+    stmt = (
+        update(model)
+        .where(model.currency.in_(list(rates)), model.price_uah.is_distinct_from(price_uah))
+        # Keeps updated_at, it tracks changes of the sheet rows
+        .values(price_uah=price_uah, updated_at=model.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(stmt)
+
+
+async def update_all_normalized_prices(rates: Dict[str, Optional[float]]):
+    async with async_session() as session:
+        for model in (bot.models.Apartments, bot.models.Houses):
+            await update_normalized_prices(session, model, rates)
         await session.commit()
-        print(delete_stmt)
+    bump_data_version()
+
+
+async def resolve_coordinates(session: AsyncSession, model: Type[bot.models.Ad], *criteria):
+    """
+    Copies coordinates of listings from geodata, matched by address, district and maps link.
+    Only rows whose coordinates differ are written.
+    :param criteria: limits the listings to update
+    """
+    geodata = bot.models.GeoData
+    coordinates = (
+        select(geodata.get_geography())
+        .where(
+            geodata.address == model.address,
+            geodata.district == model.district,
+            geodata.map_link == model.maps_link,
+        )
+        .scalar_subquery()
+    )
+    stmt = (
+        update(model)
+        .where(model.coordinates.is_distinct_from(coordinates), *criteria)
+        # Keeps updated_at, it tracks changes of the sheet rows
+        .values(coordinates=coordinates, updated_at=model.updated_at)
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(stmt)
 
 
 async def get_model_by_link(model: Type[bot.models.Ad], link: str) -> bot.models.Ad:
     async with async_session() as session:
-        stmt = select(model).where(model.link == link)
+        stmt = lambda_stmt(lambda: select(model).where(model.link == link))
         result = await session.execute(stmt)
         instance = result.fetchone()
         return instance[0] if instance else None
@@ -86,37 +363,220 @@ async def get_model_by_link(model: Type[bot.models.Ad], link: str) -> bot.models
 
 async def delete_model_by_link(model: Type[bot.models.Ad], link: str):
     async with async_session() as session:
-        delete_stmt = delete(model).where(model.link == link)
+        delete_stmt = lambda_stmt(lambda: delete(model).where(model.link == link))
         await session.execute(delete_stmt)
         await session.commit()
+    bump_data_version()
+
+
+def get_statement_cache_key(stmt: Select):
+    """
+    Structure of the statement plus values of its parameters,
+    without compiling it if SQLAlchemy can generate its cache key.
+    """
+    cache_key = stmt._generate_cache_key()
+    if cache_key is None:
+        compiled = stmt.compile(dialect=engine.dialect)
+        return str(compiled), tuple(sorted((k, repr(v)) for k, v in compiled.params.items()))
+    return cache_key.key, tuple(repr(p.effective_value) for p in cache_key.bindparams)
+
+
+def get_facets_cache_key(sources: List[Tuple[Select, Column]]):
+    return tuple(
+        (get_statement_cache_key(source_query), col.key) for source_query, col in sources
+    )
+
+
+def collect_facets(rows, cols: List[Column], grouped: bool) -> List[Dict[Any, int]]:
+    """
+    Splits GROUP BY rows into facets of each column.
+    Rows are (*values, *grouping flags if grouped, *counts), one count per column or a common one.
+    """
+    facets = [{} for _ in cols]
+    count_offset = len(cols) * 2 if grouped else len(cols)
+    for row in rows:
+        counts = row[count_offset:]
+        for i, col in enumerate(cols):
+            if grouped and row[len(cols) + i]:
+                # Row of another grouping set
+                continue
+            value = row[i]
+            count = counts[i] if len(counts) > 1 else counts[0]
+            if not count or value is None or (not isinstance(col.type, Integer) and value == " "):
+                continue
+            facets[i][value] = count
+    return facets
+
+
+def get_facet_order(col: ColumnElement) -> ColumnElement:
+    """
+    Strings are ordered by code point, like the listing index orders its categories,
+    so buttons keep their positions whichever of them answers.
+    """
+    return col.collate("C") if isinstance(col.type, String) else col
+
+
+async def get_facets(source_query: Select, cols: List[Column]) -> Dict[str, Dict[Any, int]]:
+    """
+    Distinct values of several columns of source_query with their row counts, in one round trip.
+    Results are cached until the next write to listings, callers must not mutate them.
+    :return: {column key: {value: count}}, ordered and filtered like the filter buttons expect
+    """
+    cache_key = get_facets_cache_key([(source_query, col) for col in cols])
+    version = data_version
+    facets = facets_cache.get(cache_key, version)
+    if facets is not None:
+        return facets
 
+    async with async_session() as session:
+        subquery = source_query.subquery()
+        columns = [subquery.c[col.key] for col in cols]
+
+        query = select(*columns)
+        grouped = len(columns) > 1
+        if grouped:
+            query = query.add_columns(*[func.grouping(c) for c in columns]).group_by(
+                func.grouping_sets(*columns)
+            )
+        else:
+            query = query.group_by(*columns)
+        query = query.add_columns(func.count()).order_by(*[get_facet_order(c) for c in columns])
+        result = await session.execute(query)
 
-async def get_unique_el_from_db(source_query: Select, col: Column):
+        facets = collect_facets(result.fetchall(), cols, grouped)
+        facets = {col.key: facet for col, facet in zip(cols, facets)}
+
+    facets_cache.set(cache_key, version, facets)
+    return facets
+
+
+async def get_chain_facets(sources: List[Tuple[Select, Column]]) -> List[Dict[Any, int]]:
+    """
+    Facets of every (source query, column) pair of a filter chain in one round trip.
+    Each source is the previous one with more criteria (or an outer join with at most
+    one matching row), so all of them are answered by one scan over the FROM of the last
+    source, grouped by GROUPING SETS with a count filtered by the criteria of each source.
+    """
+    cache_key = get_facets_cache_key(sources)
+    version = data_version
+    facets = facets_cache.get(cache_key, version)
+    if facets is not None:
+        return facets
+
+    cols = [col for _, col in sources]
+    counts = []
+    for source_query, _ in sources:
+        criteria = source_query.whereclause
+        counts.append(func.count() if criteria is None else func.count().filter(criteria))
+
+    query = select(*cols).select_from(*sources[-1][0].get_final_froms())
+    first_criteria = sources[0][0].whereclause
+    if first_criteria is not None:
+        query = query.where(first_criteria)
+    query = (
+        query.add_columns(*[func.grouping(c) for c in cols], *counts)
+        .group_by(func.grouping_sets(*cols))
+        .order_by(*[get_facet_order(c) for c in cols])
+    )
+    async with async_session() as session:
+        result = await session.execute(query)
+        facets = collect_facets(result.fetchall(), cols, grouped=True)
+
+    facets_cache.set(cache_key, version, facets)
+    return facets
+
+
+def get_result_order(source, point: Optional[ColumnElement] = None) -> Tuple[ColumnElement, bool]:
+    """
+    Sort key of results and whether it is ascending.
+    Results are ordered newest first, or nearest to point first. Distance is the KNN
+    operator, so Postgres walks the GiST index of coordinates in distance order.
+    Ties are ordered by id in the same direction.
+    """
+    if point is None:
+        return source.c.created_at, False
+    return source.c.coordinates.op("<->", return_type=Float)(point), True
+
+
+async def get_result_page(
+        source_query: Select,
+        limit: int,
+        after: Optional[Tuple[Any, int]] = None,
+        point: Optional[ColumnElement] = None,
+) -> List[Tuple[str, Any, int]]:
+    """
+    One page of results, ordered by (sort key, id) as get_result_order defines,
+    so the last row of a page is the cursor for the next one.
+    :return: List of (link, created_at or distance, id)
+    """
     async with async_session() as session:
-        column_obj = column(col.key)
+        subquery = source_query.subquery()
+        key, ascending = get_result_order(subquery, point)
+        id_ = subquery.c.id
+        query = select(subquery.c.link, key, id_).limit(limit)
+        if ascending:
+            query = query.order_by(key, id_)
+            if after is not None:
+                query = query.where(tuple_(key, id_) > tuple_(*after))
+        else:
+            query = query.order_by(desc(key), desc(id_))
+            if after is not None:
+                query = query.where(tuple_(key, id_) < tuple_(*after))
+        result = await session.execute(query)
 
-        query = (
-            select(column_obj).distinct().select_from(source_query).order_by(column_obj)
-        )
-        if not isinstance(col.type, Integer):
-            query = query.filter(column_obj != " ")
+        return [tuple(row) for row in result.fetchall()]
+
+
+async def get_result_rows_by_ids(
+        model: Type[bot.models.Ad], ids: List[int], point: Optional[ColumnElement] = None
+) -> List[Tuple[str, Any, int]]:
+    """Same rows as get_result_page returns, in the order of ids. Ids that are gone are skipped."""
+    async with async_session() as session:
+        key, _ = get_result_order(model.__table__, point)
+        query = select(model.link, key, model.id).where(model.id.in_(ids))
         result = await session.execute(query)
+        rows = {row[2]: tuple(row) for row in result.fetchall()}
 
-        value = result.fetchall()
-        return [v[0] for v in value]
+        return [rows[i] for i in ids if i in rows]
 
 
-async def get_result(source_query: Select, model: Type[bot.models.Ad]):
+async def get_result_count(source_query: Select) -> int:
     async with async_session() as session:
-        col_to_search = column("link")
-        query = (
-            select(col_to_search).select_from(source_query).order_by(desc("created_at"))
-        )
+        result = await session.execute(select(func.count()).select_from(source_query.subquery()))
+        return result.scalar()
+
+
+# Plain functions instead of GeoAlchemy2 ones, their types would disable the SQL cache
+def make_point(lat: float, lng: float) -> ColumnElement:
+    point = Function("ST_MakePoint", lng, lat, type_=bot.models.CacheableGeometry)
+    return cast(point, bot.models.CacheableGeography(geometry_type=None))
+
+
+def dwithin(coordinates: ColumnElement, point: ColumnElement, radius_m: float) -> ColumnElement:
+    """
+    ST_DWithin of geography coordinates, answered by their GiST index.
+    use_spheroid=false keeps distances spherical, like ST_DistanceSphere.
+    """
+    return Function("ST_DWithin", coordinates, point, radius_m, False, type_=Boolean)
+
+
+async def get_radius_counts(source_query: Select, point: ColumnElement, radiuses_m: List[float]) -> List[int]:
+    """Number of results closer than each of the radiuses to point, in one scan"""
+    async with async_session() as session:
+        subquery = source_query.subquery()
+        coordinates = subquery.c.coordinates
+        query = select(
+            *[func.count().filter(dwithin(coordinates, point, r)) for r in radiuses_m]
+        ).where(dwithin(coordinates, point, max(radiuses_m)))
         result = await session.execute(query)
 
-        value = result.fetchall()
-        # logging.debug(value)
-        return [v[0] for v in value]
+        return list(result.one())
+
+
+async def has_result(source_query: Select) -> bool:
+    async with async_session() as session:
+        result = await session.execute(select(source_query.exists()))
+        return bool(result.scalar())
 
 
 async def get_user(user_id: int):
@@ -142,9 +602,92 @@ async def write_data_to_geodata_table(address: str, district: str, map_link: str
         session.add(row)
         await session.commit()
 
+        for model in (bot.models.Apartments, bot.models.Houses):
+            await resolve_coordinates(session, model, model.address == address, model.district == district)
+        await session.commit()
+    bump_data_version()
+
     return row
 
 
+async def write_geodata_rows(rows: List[Dict]):
+    """
+    Batched write_data_to_geodata_table: one upsert for all rows, then coordinates of listings are resolved once.
+    :param rows: List of {address, district, map_link, coordinates: {lat, lng}}
+    """
+    # An upsert can't touch the same row twice, the last one wins
+    values = list({
+        (row["address"], row["district"]): {
+            "address": row["address"],
+            "district": row["district"],
+            "map_link": row["map_link"],
+            "coordinates": f'POINT({row["coordinates"]["lng"]} {row["coordinates"]["lat"]})',
+        }
+        for row in rows
+    }.values())
+    if not values:
+        return
+    async with async_session() as session:
+        for i in range(0, len(values), GEODATA_BATCH_SIZE):
+            stmt = insert(bot.models.GeoData).values(values[i:i + GEODATA_BATCH_SIZE])
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[bot.models.GeoData.address, bot.models.GeoData.district],
+                set_={"map_link": stmt.excluded.map_link, "coordinates": stmt.excluded.coordinates},
+            )
+            await session.execute(stmt)
+        for model in (bot.models.Apartments, bot.models.Houses):
+            await resolve_coordinates(session, model)
+        await session.commit()
+    bump_data_version()
+
+
+async def get_cached_map_links(links: List[str]) -> Dict[str, dict]:
+    cached = {}
+    async with async_session() as session:
+        # Every link is a bind parameter, asyncpg allows 32767 of them per statement
+        for i in range(0, len(links), GEODATA_BATCH_SIZE):
+            stmt = select(bot.models.MapLink).where(bot.models.MapLink.link.in_(links[i:i + GEODATA_BATCH_SIZE]))
+            result = await session.execute(stmt)
+            cached.update({row.link: {"lat": row.lat, "lng": row.lng} for row in result.scalars()})
+    return cached
+
+
+async def save_map_links(coordinates: Dict[str, dict]):
+    values = [{"link": link, "lat": c["lat"], "lng": c["lng"]} for link, c in coordinates.items()]
+    async with async_session() as session:
+        for i in range(0, len(values), GEODATA_BATCH_SIZE):
+            stmt = insert(bot.models.MapLink).values(values[i:i + GEODATA_BATCH_SIZE]).on_conflict_do_nothing()
+            await session.execute(stmt)
+        await session.commit()
+
+
+async def get_address_geocode(address: str, district: str, residential_complex: str) -> Optional[bot.models.AddressGeocode]:
+    async with async_session() as session:
+        return await session.get(bot.models.AddressGeocode, (address, district, residential_complex))
+
+
+async def save_address_geocode(address: str, district: str, residential_complex: str, geodata: Optional[dict]):
+    """:param geodata: GoogleMapsApi result, None if the address wasn't found"""
+    coordinates = geodata["coordinates"] if geodata else {}
+    values = {
+        "address": address,
+        "district": district,
+        "residential_complex": residential_complex,
+        "maps_link": geodata["google_maps_link"] if geodata else None,
+        "lat": coordinates.get("lat"),
+        "lng": coordinates.get("lng"),
+        "created_at": datetime.datetime.utcnow(),
+    }
+    stmt = insert(bot.models.AddressGeocode).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["address", "district", "residential_complex"],
+        set_={k: stmt.excluded[k] for k in ("maps_link", "lat", "lng", "created_at")},
+    )
+    async with async_session() as session:
+        await session.execute(stmt)
+        await session.commit()
+
+
 async def get_user_or_create_new(update: Update):
     async with async_session() as session:
         user = await get_user(update.effective_user.id)
@@ -170,6 +713,19 @@ async def save_user(user: bot.models.User):
     return user
 
 
+async def get_stored_exchange_rates() -> Dict[str, Optional[float]]:
+    async with async_session() as session:
+        result = await session.execute(select(bot.models.ExchangeRate))
+        return {row.currency: row.rate for row in result.scalars()}
+
+
+async def save_exchange_rates(rates: Dict[str, Optional[float]]):
+    async with async_session() as session:
+        for currency, rate in rates.items():
+            await session.merge(bot.models.ExchangeRate(currency=currency, rate=rate))
+        await session.commit()
+
+
 async def query_data(query):
     async with async_session() as session:
         result = await session.execute(query)
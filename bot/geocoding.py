@@ -0,0 +1,317 @@
+import asyncio
+import html
+import re
+import time
+import unicodedata
+import urllib
+from collections import defaultdict
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import httpx
+from fake_useragent import UserAgent
+
+from bot.api.google_maps import GoogleMapsApi
+from bot.db import (
+    get_cached_map_links,
+    save_map_links,
+    AddressData,
+    get_address_geocode,
+    save_address_geocode,
+)
+from bot.log import logging
+from bot.proxies import ProxyPool
+
+logger = logging.getLogger(__name__)
+
+GEOCODING_CONCURRENCY = 8
+# Minimal delay between two requests to the same host
+HOST_REQUEST_INTERVAL = 0.5
+REQUEST_TIMEOUT = 20.0
+# Parallel requests to the paid Google Maps API
+ADDRESS_GEOCODING_CONCURRENCY = 4
+# The image meta tag is in the page head, give up on pages without it after this many bytes
+MAX_CONTENT_BYTES = 2 * 1024 * 1024
+# Proxies tried for a link before it is requested directly
+PROXY_ATTEMPTS = 2
+# Answers meaning the proxy is banned or broken rather than the link
+PROXY_BLOCKED_STATUSES = {403, 407, 429}
+
+META_TAG_RE = re.compile(rb"<meta\b[^>]*>", re.IGNORECASE)
+ITEMPROP_IMAGE_RE = re.compile(rb'\bitemprop\s*=\s*["\']?image["\'\s/>]', re.IGNORECASE)
+CONTENT_ATTR_RE = re.compile(
+    rb'\bcontent\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE
+)
+
+
+def parse_lat_lng_from_url(url: str) -> Optional[dict]:
+    p = urlparse(url)
+    split_geodata = p.path.split("@")
+    if len(split_geodata) == 2:
+        list_result = split_geodata[1].split(",")[0:2]
+        return {"lat": list_result[0], "lng": list_result[1]}
+    return None
+
+
+class MetaImageScanner:
+    """Finds content of the first meta[itemprop=image] in a page fed chunk by chunk"""
+
+    def __init__(self):
+        # Start of a meta tag cut by the chunk boundary
+        self.tail = b""
+
+    def feed(self, chunk: bytes) -> Optional[str]:
+        data = self.tail + chunk
+        end = 0
+        for match in META_TAG_RE.finditer(data):
+            end = match.end()
+            tag = match.group()
+            if ITEMPROP_IMAGE_RE.search(tag):
+                content = CONTENT_ATTR_RE.search(tag)
+                if content:
+                    value = (
+                        content.group(1)
+                        if content.group(1) is not None
+                        else content.group(2)
+                    )
+                    return html.unescape(value.decode("utf-8", "replace"))
+
+        self.tail = b""
+        start = data.rfind(b"<", end)
+        if start != -1:
+            tail = data[start:]
+            if b">" not in tail and (
+                tail[:5].lower() == b"<meta" or b"<meta".startswith(tail.lower())
+            ):
+                self.tail = tail
+        return None
+
+
+async def parse_lat_lng_from_content(response: httpx.Response) -> Optional[dict]:
+    """Reads the streamed response only up to the image meta tag"""
+    scanner = MetaImageScanner()
+    received = 0
+    async for chunk in response.aiter_bytes():
+        content = scanner.feed(chunk)
+        if content is not None:
+            return parse_lat_lng_from_url_query(content)
+        received += len(chunk)
+        if received > MAX_CONTENT_BYTES:
+            break
+    return None
+
+
+def parse_lat_lng_from_url_query(url: str) -> Optional[dict]:
+    enc_query = urllib.parse.unquote(urlparse(url).query)
+    if enc_query:
+        geos_unparsed = enc_query.split(";")[0].split(",")
+        if len(geos_unparsed) >= 2:
+            lat = re.findall(r"[+-]?[0-9]*[.][0-9]+", geos_unparsed[0])
+            lng = re.findall(r"[+-]?[0-9]*[.][0-9]+", geos_unparsed[1])
+            if lat and lng:
+                return {"lat": float(lat[0]), "lng": float(lng[0])}
+    return None
+
+
+class HostRateLimiter:
+    """Spaces requests to the same host by at least interval seconds"""
+
+    def __init__(self, interval: float = HOST_REQUEST_INTERVAL):
+        self.interval = interval
+        self.locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.next_slot: Dict[str, float] = defaultdict(float)
+
+    async def wait(self, url: str):
+        host = urlparse(url).netloc
+        async with self.locks[host]:
+            delay = self.next_slot[host] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.next_slot[host] = time.monotonic() + self.interval
+
+
+def create_client(**kwargs) -> httpx.AsyncClient:
+    """One pooled client for a whole geocoding run"""
+    headers = {"user-agent": UserAgent().random}
+    return httpx.AsyncClient(
+        follow_redirects=True, headers=headers, timeout=REQUEST_TIMEOUT, **kwargs
+    )
+
+
+class Geocoder:
+    """
+    Resolves maps links to coordinates with bounded concurrency and per host rate limit.
+    Resolved links are kept in the map_links table, so a link is resolved only once.
+    """
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        concurrency: int = GEOCODING_CONCURRENCY,
+        rate_limiter: Optional[HostRateLimiter] = None,
+        proxy_pool: Optional[ProxyPool] = None,
+    ):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate_limiter = rate_limiter or HostRateLimiter()
+        self.proxy_pool = proxy_pool
+
+    async def get_lat_lng(self, link: str) -> Optional[dict]:
+        first_try = parse_lat_lng_from_url(link)
+        if first_try:
+            return first_try
+        async with self.semaphore:
+            await self.rate_limiter.wait(link)
+            tried = []
+            while self.proxy_pool is not None and len(tried) < PROXY_ATTEMPTS:
+                proxy = self.proxy_pool.get_best(exclude=tried)
+                if proxy is None:
+                    break
+                tried.append(proxy)
+                try:
+                    return await self.fetch_lat_lng_via_proxy(link, proxy)
+                except httpx.TransportError:
+                    logger.info("Proxy %s failed for %s", proxy, link)
+            return await self.fetch_lat_lng(self.client, link)
+
+    async def fetch_lat_lng_via_proxy(self, link: str, proxy: str) -> Optional[dict]:
+        client = self.proxy_pool.get_client(proxy)
+        stats = self.proxy_pool.start(proxy)
+        started = time.monotonic()
+        try:
+            result = await self.fetch_lat_lng(client, link)
+        except httpx.TransportError:
+            await self.proxy_pool.finish(stats, ok=False)
+            raise
+        await self.proxy_pool.finish(stats, ok=True, latency=time.monotonic() - started)
+        return result
+
+    async def fetch_lat_lng(
+        self, client: httpx.AsyncClient, link: str
+    ) -> Optional[dict]:
+        async with client.stream("GET", link, headers=self.client.headers) as r:
+            logger.info("short_url:%s URL: %s CODE: %s", link, r.url, r.status_code)
+            if client is not self.client and r.status_code in PROXY_BLOCKED_STATUSES:
+                raise httpx.ProxyError(
+                    f"Proxy answered {r.status_code}", request=r.request
+                )
+            if r.status_code >= 400:
+                return None
+            url = str(r.url)
+            # The page body is downloaded only when the final url has no coordinates
+            if "@" in url:
+                second_try = parse_lat_lng_from_url(url)
+                if second_try:
+                    return second_try
+            third_try = await parse_lat_lng_from_content(r)
+            if third_try:
+                return third_try
+        return parse_lat_lng_from_url_query(url)
+
+    async def resolve(self, link: str) -> Optional[dict]:
+        try:
+            coordinates = await self.get_lat_lng(link)
+            if coordinates is None:
+                return None
+            return {"lat": float(coordinates["lat"]), "lng": float(coordinates["lng"])}
+        except (httpx.HTTPError, ValueError, IndexError):
+            # A malformed link fails alone, the rest of the batch is still saved
+            logger.warning("Can't resolve maps link %s", link, exc_info=True)
+            return None
+
+    async def resolve_all(self, links: List[str]) -> Dict[str, Optional[dict]]:
+        """
+        :return: {link: {'lat': float, 'lng': float} or None if it can't be resolved}
+        """
+        links = list(dict.fromkeys(links))
+        result: Dict[str, Optional[dict]] = await get_cached_map_links(links)
+        missing = [link for link in links if link not in result]
+
+        resolved = await asyncio.gather(*[self.resolve(link) for link in missing])
+        found = {
+            link: coordinates
+            for link, coordinates in zip(missing, resolved)
+            if coordinates
+        }
+        if found:
+            await save_map_links(found)
+
+        logger.info(
+            "Maps links: %s cached, %s resolved, %s broken",
+            len(result),
+            len(found),
+            len(missing) - len(found),
+        )
+        result.update({link: found.get(link) for link in missing})
+        return result
+
+
+def normalize_address_part(value: Optional[str]) -> str:
+    """Spelling variants of the same address part share one key: case, punctuation and spaces are ignored"""
+    if not value:
+        return ""
+    value = (
+        unicodedata.normalize("NFKC", value).lower().replace("ʼ", "'").replace("’", "'")
+    )
+    value = re.sub(r"[^\w']+", " ", value)
+    return " ".join(value.split())
+
+
+class AddressGeocoder:
+    """
+    Geocodes addresses with Google Maps API. Answers are kept in the address_geocodes table
+    under a normalized (address, district, residential complex), so an address is paid for once.
+    """
+
+    def __init__(
+        self, api: GoogleMapsApi, concurrency: int = ADDRESS_GEOCODING_CONCURRENCY
+    ):
+        self.api = api
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    @staticmethod
+    def get_key(address_data: AddressData) -> tuple:
+        return (
+            normalize_address_part(address_data.address),
+            normalize_address_part(address_data.district),
+            normalize_address_part(address_data.residential_complex),
+        )
+
+    async def geocode(self, address_data: AddressData) -> Optional[dict]:
+        """:return: {'google_maps_link': str, 'coordinates': {'lat': float, 'lng': float}} or None if not found"""
+        key = self.get_key(address_data)
+        cached = await get_address_geocode(*key)
+        if cached is not None:
+            if cached.lat is None or cached.lng is None:
+                return None
+            return {
+                "google_maps_link": cached.maps_link,
+                "coordinates": {"lat": cached.lat, "lng": cached.lng},
+            }
+
+        google_query, _ = address_data.build_google_query_and_user_text()
+        async with self.semaphore:
+            try:
+                geodata = await self.api.get_geodata_by_address(google_query)
+            except (httpx.HTTPError, ValueError):
+                # Not cached, the address is looked up again next time
+                logger.warning("Can't geocode %s", google_query, exc_info=True)
+                return None
+        await save_address_geocode(*key, geodata)
+        return geodata
+
+    async def geocode_all(self, addresses: List[AddressData]) -> List[Optional[dict]]:
+        return await asyncio.gather(
+            *[self.geocode(address_data) for address_data in addresses]
+        )
+
+
+_address_geocoder: Optional[AddressGeocoder] = None
+
+
+def get_address_geocoder() -> AddressGeocoder:
+    """Shared geocoder, its http client is kept open for the bot lifetime"""
+    global _address_geocoder
+    if _address_geocoder is None:
+        _address_geocoder = AddressGeocoder(GoogleMapsApi())
+    return _address_geocoder
@@ -0,0 +1,241 @@
+from typing import Any, Dict, List, Optional, Tuple, Type
+
+import numpy as np
+from geoalchemy2 import Geometry
+from sqlalchemy import select, desc, func, cast
+
+import bot.models
+from bot.db import async_session, bump_data_version
+from bot.log import logging
+from bot.spatial_index import SpatialGrid, haversine
+
+logger = logging.getLogger(__name__)
+
+NO_VALUE = -1
+
+CATEGORICAL_COLUMNS = ["district", "residential_complex", "currency", "kids", "pets"]
+NUMERIC_COLUMNS = ["id", "rooms", "rent_price", "living_area"]
+
+
+def encode(values: List[Optional[str]]):
+    """
+    Dictionary-encodes a string column.
+    Categories are in code point order, as get_facets orders them in Postgres.
+    :return: (codes, categories), None is encoded as NO_VALUE
+    """
+    categories = sorted({v for v in values if v is not None})
+    positions = {v: i for i, v in enumerate(categories)}
+    codes = np.fromiter(
+        (positions.get(v, NO_VALUE) if v is not None else NO_VALUE for v in values),
+        dtype=np.int32,
+        count=len(values),
+    )
+    return codes, categories
+
+
+class ListingIndex:
+    """
+    Column arrays of one listing table.
+    Rows are kept in the order results are shown to users (newest first),
+    so a boolean mask over the index is already an ordered result.
+    """
+
+    def __init__(self, model: Type[bot.models.Ad], rows: List[Dict]):
+        self.model = model
+        self.size = len(rows)
+        self.links = np.array([r["link"] for r in rows], dtype=object)
+        self.created_at = np.array(
+            [r["created_at"] for r in rows], dtype="datetime64[us]"
+        )
+        self.alive = np.ones(self.size, dtype=bool)
+        self.codes: Dict[str, np.ndarray] = {}
+        self.categories: Dict[str, List[str]] = {}
+        self.numbers: Dict[str, np.ndarray] = {}
+
+        for key in CATEGORICAL_COLUMNS:
+            if hasattr(model, key):
+                self.codes[key], self.categories[key] = encode([r[key] for r in rows])
+        for key in NUMERIC_COLUMNS:
+            if hasattr(model, key):
+                self.numbers[key] = np.array([r[key] for r in rows], dtype=np.int64)
+
+        self.positions = {id_: p for p, id_ in enumerate(self.numbers["id"].tolist())}
+
+        self.price_uah = np.array(
+            [np.nan if r["price_uah"] is None else r["price_uah"] for r in rows],
+            dtype=np.float64,
+        )
+        self.lat = np.array(
+            [np.nan if r["lat"] is None else r["lat"] for r in rows], dtype=np.float64
+        )
+        self.lng = np.array(
+            [np.nan if r["lng"] is None else r["lng"] for r in rows], dtype=np.float64
+        )
+        self.grid = SpatialGrid(self.lat, self.lng)
+
+    def all(self) -> np.ndarray:
+        return self.alive.copy()
+
+    def isin(self, key: str, values) -> np.ndarray:
+        if key in self.codes:
+            positions = {v: i for i, v in enumerate(self.categories[key])}
+            codes = [positions[v] for v in values if v in positions]
+            return np.isin(self.codes[key], codes)
+        return np.isin(self.numbers[key], list(values))
+
+    def facets(self, key: str, mask: np.ndarray) -> Dict:
+        """Mirrors get_facets: distinct values with counts, blanks skipped."""
+        if key in self.codes:
+            categories = self.categories[key]
+            codes, counts = np.unique(
+                self.codes[key][mask & self.alive], return_counts=True
+            )
+            return {
+                categories[c]: n
+                for c, n in zip(codes.tolist(), counts.tolist())
+                if c != NO_VALUE and categories[c] != " "
+            }
+        values, counts = np.unique(
+            self.numbers[key][mask & self.alive], return_counts=True
+        )
+        return dict(zip(values.tolist(), counts.tolist()))
+
+    def unique(self, key: str, mask: np.ndarray) -> list:
+        return list(self.facets(key, mask))
+
+    def distance_to(self, lat: float, lng: float) -> np.ndarray:
+        """Haversine distance in meters, nan for listings without coordinates."""
+        return haversine(lat, lng, self.lat, self.lng)
+
+    def within(self, lat: float, lng: float, radius_m: float) -> np.ndarray:
+        """Mask of listings closer than radius_m, looked up in the spatial grid"""
+        mask = np.zeros(self.size, dtype=bool)
+        mask[self.grid.within(lat, lng, radius_m)] = True
+        return mask
+
+    def count_within(
+        self, mask: np.ndarray, lat: float, lng: float, radiuses_m: List[float]
+    ) -> List[int]:
+        """Number of listings of the mask closer than each of the radiuses, from one distance computation"""
+        positions, distance = self.grid.distances(lat, lng, max(radiuses_m))
+        distance = np.sort(distance[(mask & self.alive)[positions]])
+        return np.searchsorted(distance, radiuses_m, side="left").tolist()
+
+    def links_for(self, mask: np.ndarray) -> List[str]:
+        return self.links[mask & self.alive].tolist()
+
+    def order(
+        self, mask: np.ndarray, location: Optional[Tuple[float, float]] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Mirrors get_result_order: positions of the mask newest first, or nearest to location first.
+        :return: (positions, sort keys)
+        """
+        positions = np.flatnonzero(mask & self.alive)
+        if location is None:
+            return positions, self.created_at[positions]
+        distance = haversine(*location, self.lat[positions], self.lng[positions])
+        order = np.lexsort((self.numbers["id"][positions], distance))
+        return positions[order], distance[order]
+
+    def ids_for(
+        self, mask: np.ndarray, location: Optional[Tuple[float, float]] = None
+    ) -> np.ndarray:
+        return self.numbers["id"][self.order(mask, location)[0]]
+
+    def get_row(self, p: int, key) -> Tuple[str, Any, int]:
+        key = key.item() if isinstance(key, np.generic) else key
+        return self.links[p], key, int(self.numbers["id"][p])
+
+    def rows_by_ids(
+        self, ids, location: Optional[Tuple[float, float]] = None
+    ) -> List[Tuple[str, Any, int]]:
+        """Mirrors get_result_rows_by_ids"""
+        rows = []
+        for id_ in ids:
+            p = self.positions.get(id_)
+            if p is not None and self.alive[p]:
+                if location is None:
+                    key = self.created_at[p]
+                else:
+                    key = haversine(*location, self.lat[p], self.lng[p])
+                rows.append(self.get_row(p, key))
+        return rows
+
+    def count(self, mask: np.ndarray) -> int:
+        return int(np.count_nonzero(mask & self.alive))
+
+    def any(self, mask: np.ndarray) -> bool:
+        return bool((mask & self.alive).any())
+
+    def page(
+        self,
+        mask: np.ndarray,
+        limit: int,
+        after: Optional[Tuple[Any, int]] = None,
+        location: Optional[Tuple[float, float]] = None,
+    ) -> List[Tuple[str, Any, int]]:
+        """Mirrors get_result_page"""
+        positions, keys = self.order(mask, location)
+        if after is not None:
+            ids = self.numbers["id"][positions]
+            if location is None:
+                key = np.datetime64(after[0], "us")
+                keep = (keys < key) | ((keys == key) & (ids < after[1]))
+            else:
+                keep = (keys > after[0]) | ((keys == after[0]) & (ids > after[1]))
+            positions, keys = positions[keep], keys[keep]
+        return [self.get_row(p, key) for p, key in zip(positions[:limit], keys[:limit])]
+
+    def remove_link(self, link: str):
+        self.alive &= self.links != link
+
+
+_indexes: Dict[str, ListingIndex] = {}
+
+
+def get_listing_index(model: Type[bot.models.Ad]) -> Optional[ListingIndex]:
+    """Returns None while the index is cold, callers fall back to Postgres."""
+    return _indexes.get(model.__tablename__)
+
+
+async def rebuild_listing_index(model: Type[bot.models.Ad]):
+    columns = [
+        getattr(model, key)
+        for key in CATEGORICAL_COLUMNS + NUMERIC_COLUMNS
+        if hasattr(model, key)
+    ]
+    stmt = select(
+        model.link,
+        model.created_at,
+        model.price_uah,
+        *columns,
+        func.ST_Y(cast(model.coordinates, Geometry)).label("lat"),
+        func.ST_X(cast(model.coordinates, Geometry)).label("lng"),
+    ).order_by(desc(model.created_at), desc(model.id))
+    try:
+        async with async_session() as session:
+            rows = [dict(r._mapping) for r in await session.execute(stmt)]
+    except Exception:
+        logger.exception("Can't rebuild listing index for %s", model.__tablename__)
+        return None
+
+    index = ListingIndex(model, rows)
+    _indexes[model.__tablename__] = index
+    # Results cached while the old index was still serving are stale now
+    bump_data_version()
+    logger.info(
+        "Listing index for %s rebuilt: %s rows", model.__tablename__, index.size
+    )
+    return index
+
+
+async def rebuild_listing_indexes():
+    await rebuild_listing_index(bot.models.Apartments)
+    await rebuild_listing_index(bot.models.Houses)
+
+
+def remove_link_from_indexes(link: str):
+    for index in _indexes.values():
+        index.remove_link(link)
+    bump_data_version()
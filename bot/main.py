@@ -17,6 +17,7 @@ from telegram.ext import (
 from bot import config
 from bot.ads.handlers import ads_dialog_handler
 from bot.ads.navigation.constants import ADS_DIALOG_STAGE
+from bot.api.monobank_currency import run_exchange_rates_refresher
 from bot.context.filters import (
     RoomsFilter,
     DistrictFilter,
@@ -24,6 +25,7 @@ from bot.context.filters import (
     PriceFilter,
     AdditionalFilter, )
 from bot.context.message_forwarder import MessageForwarder
+from bot.listing_index import rebuild_listing_indexes
 from bot.log import logging
 from bot.models import Apartments, Houses
 from bot.navigation.basic_keyboard_builder import show_menu
@@ -44,14 +46,19 @@ from bot.navigation.constants import (
     TOTAL_SUBSCRIBED_USERS_STATE,
     CANCEL_SUBSCRIPTION_STATE,
     MAIN_MENU_STATE, RENT_STAGE, RENT_STATE, ADS_STATE, ADS_STAGE, ADS_APS_STATE, HELP_STAGE, SUBMIT_HELP_STATE,
-    SUBMIT_STATE, GEO_DATA_STAGE, CHECK_GEOLINK_STATE, MAIN_MENU_TEXT, )
+    SUBMIT_STATE, GEO_DATA_STAGE, CHECK_GEOLINK_STATE, MAIN_MENU_TEXT, CACHE_STATS_STATE, PROXY_STATS_STATE, )
 from bot.stages.admin_stage import admin_menu, get_total_users, get_recent_hour_users, \
-    get_total_users_with_subscription, check_geolink, submit_geolink, user_geolink, create_refresh_handler, sync_data
+    get_total_users_with_subscription, check_geolink, submit_geolink, user_geolink, create_refresh_handler, sync_data, \
+    get_cache_stats, get_proxy_stats
 from bot.stages.ads_stage import ads_handler
 from bot.stages.help_stage import help_message_handler, submit_help, help_ask
 from bot.stages.rent_stage import create_filter_handler, rent_handler, subscription, cancel_subscription
 
 logger = logging.getLogger(__name__)
+
+SYNC_INTERVAL_MINUTES = 5
+# How often due scheduled jobs are checked
+SCHEDULE_TICK = 30
 sentry_sdk.init(dsn=config.SENTRY_DSN,
                 traces_sample_rate=1.0,
                 environment=config.SENTRY_ENV
@@ -208,6 +215,14 @@ def main() -> None:
                     check_geolink,
                     pattern="^" + str(CHECK_GEOLINK_STATE) + "$",
                 ),
+                CallbackQueryHandler(
+                    get_cache_stats,
+                    pattern="^" + str(CACHE_STATS_STATE) + "$",
+                ),
+                CallbackQueryHandler(
+                    get_proxy_stats,
+                    pattern="^" + str(PROXY_STATS_STATE) + "$",
+                ),
 
             ],
             GEO_DATA_STAGE: [
@@ -272,17 +287,23 @@ def main() -> None:
     application.add_handler(conv_handler)
     loop = asyncio.get_event_loop()
 
+    loop.create_task(run_exchange_rates_refresher())
     loop.create_task(start_schedules(forwarder))
     application.run_polling()
     app.stop()
 
 
 async def start_schedules(forwarder: MessageForwarder):
-    schedule.every(2).hours.do(sync_data, forwarder=forwarder)
+    await rebuild_listing_indexes()
+    # Cheap when nobody edited the spreadsheet, sync skips it after one Drive request
+    schedule.every(SYNC_INTERVAL_MINUTES).minutes.do(sync_data, forwarder=forwarder)
 
     while True:
-        await asyncio.sleep(360)
-        await schedule.run_pending()
+        await asyncio.sleep(SCHEDULE_TICK)
+        try:
+            await schedule.run_pending()
+        except Exception:
+            logger.exception("Scheduled job failed")
 
 
 if __name__ == "__main__":
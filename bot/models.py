@@ -1,7 +1,7 @@
 import datetime
 from typing import Dict, Any
 
-from geoalchemy2 import Geometry
+from geoalchemy2 import Geometry, Geography
 from sqlalchemy import (
     Column,
     Integer,
@@ -12,12 +12,28 @@ from sqlalchemy import (
     select,
     BigInteger,
     LargeBinary,
+    Float,
+    Index,
+    cast,
 )
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import declarative_base, declared_attr
 
 Base = declarative_base()
 
 
+class CacheableGeometry(Geometry):
+    """
+    GeoAlchemy2 marks its types as not safe to cache, which keeps SQLAlchemy from caching
+    the compiled SQL of every statement touching geodata. All arguments of Geometry are
+    hashable scalars, so it is safe to cache.
+    """
+    cache_ok = True
+
+
+class CacheableGeography(Geography):
+    cache_ok = True
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -64,6 +80,30 @@ class Ad(Base):
     district = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, onupdate=datetime.datetime.utcnow)
+    # Copied from geodata on sync, so radius search needs no join
+    coordinates = Column(
+        CacheableGeography(geometry_type="POINT", srid=4326, spatial_index=False),
+        nullable=True,
+    )
+    # rent_price in UAH at current exchange rates, kept up to date by sync and rate refreshes
+    price_uah = Column(Float, nullable=True)
+    # Digest of the sheet row, sync skips rows with the same hash
+    content_hash = Column(String, nullable=True)
+
+    # Columns filters select by, one index per tuple
+    filter_indexes = [("district",), ("rooms",), ("price_uah",)]
+
+    @declared_attr
+    def __table_args__(cls):
+        indexes = [
+            Index(f"ix_{cls.__tablename__}_link", "link", unique=True),
+            # Results are ordered by (created_at, id), both directions are served by one index
+            Index(f"ix_{cls.__tablename__}_created_at_id", "created_at", "id"),
+            Index(f"ix_{cls.__tablename__}_coordinates", "coordinates", postgresql_using="gist"),
+        ]
+        for columns in cls.filter_indexes:
+            indexes.append(Index(f"ix_{cls.__tablename__}_{'_'.join(columns)}", *columns))
+        return tuple(indexes)
 
     def get_full_name(self):
         return f"ID: {self.id} Link: {self.link}"
@@ -71,6 +111,7 @@ class Ad(Base):
 
 class Apartments(Ad):
     __tablename__ = "apartments"
+    filter_indexes = [("district", "residential_complex"), ("rooms",), ("price_uah",)]
     residential_complex = Column(String, nullable=False)
     kids = Column(String, nullable=True)
     pets = Column(String, nullable=True)
@@ -86,6 +127,7 @@ class Apartments(Ad):
 
 class Houses(Ad):
     __tablename__ = "houses"
+    filter_indexes = Ad.filter_indexes + [("living_area",)]
 
     living_area = Column(Integer, nullable=False)
     territory_area = Column(Integer, nullable=False)
@@ -104,7 +146,7 @@ class GeoData(Base):
     address = Column(String, primary_key=True)
     district = Column(String, primary_key=True)
     map_link = Column(String, nullable=False)
-    coordinates = Column(Geometry('POINT'))
+    coordinates = Column(CacheableGeometry('POINT'))
 
     def __init__(self, address: str, district: str, map_link: str, coordinates: Dict, *args: Any, **kwargs: Any):
         self.address = address
@@ -121,3 +163,54 @@ class GeoData(Base):
 
     def __repr__(self):
         return self.address, self.map_link
+
+    @classmethod
+    def get_geography(cls):
+        return cast(cls.coordinates, CacheableGeography(geometry_type=None))
+
+
+class ExchangeRate(Base):
+    __tablename__ = "exchange_rates"
+
+    currency = Column(String, primary_key=True)
+    rate = Column(Float, nullable=True)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return "<ExchangeRate(currency='%s', rate='%s')>" % (self.currency, self.rate)
+
+
+class MapLink(Base):
+    """Coordinates a maps link resolved to, so it is never resolved twice"""
+    __tablename__ = "map_links"
+
+    link = Column(String, primary_key=True)
+    lat = Column(Float, nullable=False)
+    lng = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return "<MapLink(link='%s', lat='%s', lng='%s')>" % (self.link, self.lat, self.lng)
+
+
+class AddressGeocode(Base):
+    """
+    Google Maps API answer for a normalized (address, district, residential complex),
+    addresses the API can't find are kept too with empty coordinates
+    """
+    __tablename__ = "address_geocodes"
+
+    address = Column(String, primary_key=True)
+    district = Column(String, primary_key=True)
+    residential_complex = Column(String, primary_key=True, default='')
+    maps_link = Column(String, nullable=True)
+    lat = Column(Float, nullable=True)
+    lng = Column(Float, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    def __repr__(self):
+        return "<AddressGeocode(address='%s', district='%s', residential_complex='%s')>" % (
+            self.address,
+            self.district,
+            self.residential_complex,
+        )
@@ -12,7 +12,8 @@ from bot.navigation.constants import (
     REFRESH_DB_STATE,
     ADMIN_MENU_STATE,
     CANCEL_SUBSCRIPTION_STATE,
-    MAIN_MENU_STATE, RENT_STATE, ADS_STATE, ADS_APS_STATE, SUBMIT_HELP_STATE, CHECK_GEOLINK_STATE, SUBMIT_STATE)
+    MAIN_MENU_STATE, RENT_STATE, ADS_STATE, ADS_APS_STATE, SUBMIT_HELP_STATE, CHECK_GEOLINK_STATE, SUBMIT_STATE,
+    CACHE_STATS_STATE, PROXY_STATS_STATE)
 
 # Buttons patterns
 START_BUTTONS = {
@@ -40,6 +41,8 @@ ADMIN_BUTTONS = {
     "Всього з підпискою": TOTAL_SUBSCRIBED_USERS_STATE,
     "Оновити базу": REFRESH_DB_STATE,
     "Перевірити геолінки": CHECK_GEOLINK_STATE,
+    "Статистика кешу": CACHE_STATS_STATE,
+    "Статистика проксі": PROXY_STATS_STATE,
 }
 # Buttons Texts
 HOME_MENU_BTN_TEXT = "🏠️"
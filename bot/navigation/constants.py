@@ -25,6 +25,8 @@ ADMIN_MENU_STATE = "ADMIN_MENU_STATE"
 CANCEL_SUBSCRIPTION_STATE = "CANCEL_SUBSCRIPTION_STATE"
 REFRESH_DB_STATE = "REFRESH_DB_STATE"
 CHECK_GEOLINK_STATE = "CHECK_GEOLINK_STATE"
+CACHE_STATS_STATE = "CACHE_STATS_STATE"
+PROXY_STATS_STATE = "PROXY_STATS_STATE"
 MAIN_MENU_STATE = "MAIN_MENU_STATE"
 SUBMIT_HELP_STATE = "SUBMIT_HELP_STATE"
 SUBMIT_STATE = "SUBMIT_STATE"
@@ -47,6 +49,7 @@ SUBSCRIPTION_TEXT = (
     "коли зʼявляються обʼекти по вашим критеріям пошуку."
     " Для того щоб додати критерії до пошуку оберіть потрібний тип нерухомості."
 )
+FOUND_ITEMS_TEXT = "🔎 <i>Знайдено оголошень: {}</i>"
 EMPTY_RESULT_TEXT = (
     "Нажаль за вашими критеріями пошуку нічого не знайшлось."
     "\nСпробуйте змінити параметри пошуку,"
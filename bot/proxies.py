@@ -1,17 +1,189 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
 
 import httpx
 from lxml.html import fromstring
 
+from bot.log import logging
 
-async def get_proxies():
-    url = 'https://free-proxy-list.net/'
-    async with httpx.AsyncClient() as client:
-        r = await client.get(url)
+logger = logging.getLogger(__name__)
+
+PROXY_LIST_URL = 'https://free-proxy-list.net/'
+HEALTH_CHECK_URL = 'https://www.google.com/generate_204'
+HEALTH_CHECK_TIMEOUT = 5.0
+HEALTH_CHECK_CONCURRENCY = 20
+PROXY_TIMEOUT = 10.0
+# Proxies scraped per refresh, the list is sorted by the last check time
+MAX_SCRAPED_PROXIES = 50
+# Consecutive failures before a proxy is evicted
+MAX_FAILURES = 2
+REFRESH_INTERVAL = 30 * 60
+MIN_HEALTHY_PROXIES = 3
+# Weight of the last measured latency in the moving average
+LATENCY_SMOOTHING = 0.3
+
+
+async def get_proxies(limit: int = MAX_SCRAPED_PROXIES) -> set:
+    """HTTPS capable proxies from free-proxy-list.net as 'host:port'"""
+    async with httpx.AsyncClient(timeout=PROXY_TIMEOUT) as client:
+        r = await client.get(PROXY_LIST_URL)
         parser = fromstring(r.text)
     proxies = set()
-    for i in parser.xpath('//tbody/tr')[:10]:
+    for i in parser.xpath('//tbody/tr')[:limit]:
         if i.xpath('.//td[7][contains(text(),"yes")]'):
             proxy = ":".join([i.xpath('.//td[1]/text()')[0], i.xpath('.//td[2]/text()')[0]])
             proxies.add(proxy)
     return proxies
 
+
+@dataclass
+class ProxyStats:
+    address: str
+    successes: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    in_flight: int = 0
+    # Moving average of request seconds
+    latency: Optional[float] = None
+    client: Optional[httpx.AsyncClient] = field(default=None, repr=False)
+
+    @property
+    def success_rate(self) -> float:
+        # Smoothed, so a single lucky request doesn't beat a proven proxy
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    @property
+    def score(self) -> float:
+        """Expected seconds per successful request, lower is better"""
+        latency = self.latency if self.latency is not None else PROXY_TIMEOUT
+        return latency * (1 + self.in_flight) / self.success_rate
+
+    def record(self, ok: bool, latency: Optional[float] = None):
+        if ok:
+            self.successes += 1
+            self.consecutive_failures = 0
+            if latency is not None:
+                self.latency = latency if self.latency is None \
+                    else LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * self.latency
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+
+
+class ProxyPool:
+    """
+    Long-lived pool of free proxies. Proxies are health checked concurrently on refresh, scored by
+    latency and success rate, and evicted after MAX_FAILURES failures in a row.
+    """
+
+    def __init__(self):
+        self.proxies: Dict[str, ProxyStats] = {}
+        self.evicted = 0
+        self.refreshed_at: Optional[float] = None
+        self.refresh_lock = asyncio.Lock()
+
+    def get_client(self, proxy: str) -> httpx.AsyncClient:
+        stats = self.proxies[proxy]
+        if stats.client is None:
+            stats.client = httpx.AsyncClient(proxies=f'http://{proxy}', follow_redirects=True, timeout=PROXY_TIMEOUT)
+        return stats.client
+
+    def get_best(self, exclude=()) -> Optional[str]:
+        """Fastest healthy proxy"""
+        candidates = [stats for stats in self.proxies.values() if stats.address not in exclude]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda stats: stats.score).address
+
+    def start(self, proxy: str) -> ProxyStats:
+        stats = self.proxies[proxy]
+        stats.in_flight += 1
+        return stats
+
+    async def finish(self, stats: ProxyStats, ok: bool, latency: Optional[float] = None):
+        stats.in_flight -= 1
+        stats.record(ok, latency)
+        if stats.consecutive_failures >= MAX_FAILURES:
+            await self.evict(stats.address)
+        if self.proxies.get(stats.address) is not stats:
+            await self.close(stats)
+
+    async def evict(self, proxy: str):
+        stats = self.proxies.pop(proxy, None)
+        if stats is None:
+            return
+        self.evicted += 1
+        logger.info("Proxy %s evicted after %s failures", proxy, stats.failures)
+        await self.close(stats)
+
+    @staticmethod
+    async def close(stats: ProxyStats):
+        # Requests still going through an evicted proxy close its client when they finish
+        if stats.client is not None and stats.in_flight == 0:
+            await stats.client.aclose()
+            stats.client = None
+
+    async def check(self, proxy: str) -> bool:
+        if proxy not in self.proxies:
+            return False
+        client = self.get_client(proxy)
+        stats = self.start(proxy)
+        started = time.monotonic()
+        try:
+            r = await client.get(HEALTH_CHECK_URL, timeout=HEALTH_CHECK_TIMEOUT)
+            ok = r.status_code < 400
+        except httpx.HTTPError:
+            ok = False
+        await self.finish(stats, ok, time.monotonic() - started)
+        if not ok:
+            await self.evict(proxy)
+        return ok
+
+    async def refresh(self):
+        """Adds freshly scraped proxies and health checks the whole pool"""
+        async with self.refresh_lock:
+            try:
+                scraped = await get_proxies()
+            except httpx.HTTPError:
+                logger.warning("Can't fetch proxy list", exc_info=True)
+                scraped = set()
+            for proxy in scraped:
+                self.proxies.setdefault(proxy, ProxyStats(proxy))
+
+            semaphore = asyncio.Semaphore(HEALTH_CHECK_CONCURRENCY)
+
+            async def check(proxy):
+                async with semaphore:
+                    return await self.check(proxy)
+
+            results = await asyncio.gather(*[check(proxy) for proxy in list(self.proxies)])
+            self.refreshed_at = time.monotonic()
+            logger.info("Proxy pool refreshed: %s of %s proxies are healthy", sum(results), len(results))
+
+    async def refresh_if_stale(self):
+        stale = self.refreshed_at is None or time.monotonic() - self.refreshed_at > REFRESH_INTERVAL
+        if stale or len(self.proxies) < MIN_HEALTHY_PROXIES:
+            await self.refresh()
+
+    def get_stats(self) -> dict:
+        ranked = sorted(self.proxies.values(), key=lambda stats: stats.score)
+        return {
+            'healthy': len(self.proxies),
+            'evicted': self.evicted,
+            'successes': sum(stats.successes for stats in ranked),
+            'failures': sum(stats.failures for stats in ranked),
+            'refreshed_at': self.refreshed_at,
+            'best': ranked[:5],
+        }
+
+
+_proxy_pool: Optional[ProxyPool] = None
+
+
+def get_proxy_pool() -> ProxyPool:
+    global _proxy_pool
+    if _proxy_pool is None:
+        _proxy_pool = ProxyPool()
+    return _proxy_pool
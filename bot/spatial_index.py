@@ -0,0 +1,81 @@
+from typing import Tuple, Union
+
+import numpy as np
+
+# Sphere radius used by ST_DistanceSphere, so in-memory distances match PostGIS
+EARTH_RADIUS_M = 6370986
+# About 1.1 km of latitude, radius buttons span a few cells
+CELL_DEG = 0.01
+# Longitude cells are offset to be non-negative, so (lat cell, lng cell) packs into one sortable key
+LNG_CELLS = 1 << 20
+LNG_CELL_OFFSET = 1 << 19
+
+
+def haversine(lat: float, lng: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    """Distance in meters from (lat, lng) to each of the points, nan for missing coordinates"""
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    lat2, lng2 = np.radians(lats), np.radians(lngs)
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+def get_cell(degrees: Union[float, np.ndarray]):
+    return np.floor(np.asarray(degrees) / CELL_DEG).astype(np.int64)
+
+
+class SpatialGrid:
+    """
+    Grid of CELL_DEG cells over the points.
+    Positions are sorted by cell key, so cells of one latitude row are a contiguous slice
+    and a radius query is one binary search per row plus exact distances of the candidates.
+    """
+
+    def __init__(self, lats: np.ndarray, lngs: np.ndarray):
+        self.lats = lats
+        self.lngs = lngs
+        located = np.flatnonzero(~np.isnan(lats) & ~np.isnan(lngs))
+        keys = self.get_keys(get_cell(lats[located]), get_cell(lngs[located]))
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.positions = located[order]
+
+    @staticmethod
+    def get_keys(lat_cells, lng_cells):
+        return lat_cells * LNG_CELLS + (lng_cells + LNG_CELL_OFFSET)
+
+    def candidates(self, lat: float, lng: float, radius_m: float) -> np.ndarray:
+        """Positions of points in cells the circle touches"""
+        lat_delta = np.degrees(radius_m / EARTH_RADIUS_M)
+        # Longitude degrees shrink towards the poles, the widest span is at the latitude farthest from equator
+        widest_lat = min(abs(lat) + lat_delta, 89.9)
+        lng_delta = lat_delta / np.cos(np.radians(widest_lat))
+
+        lng_from, lng_to = get_cell(lng - lng_delta), get_cell(lng + lng_delta)
+        chunks = []
+        for lat_cell in range(get_cell(lat - lat_delta), get_cell(lat + lat_delta) + 1):
+            start = np.searchsorted(
+                self.keys, self.get_keys(lat_cell, lng_from), side="left"
+            )
+            end = np.searchsorted(
+                self.keys, self.get_keys(lat_cell, lng_to), side="right"
+            )
+            chunks.append(self.positions[start:end])
+        if not chunks:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(chunks)
+
+    def distances(
+        self, lat: float, lng: float, radius_m: float
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Positions of points closer than radius_m to (lat, lng) and their distances"""
+        positions = self.candidates(lat, lng, radius_m)
+        distance = haversine(lat, lng, self.lats[positions], self.lngs[positions])
+        inside = distance < radius_m
+        return positions[inside], distance[inside]
+
+    def within(self, lat: float, lng: float, radius_m: float) -> np.ndarray:
+        """Positions of points closer than radius_m to (lat, lng)"""
+        return self.distances(lat, lng, radius_m)[0]
@@ -1,28 +1,24 @@
 import datetime
-import re
-import urllib
-from itertools import cycle
-from typing import Optional
-from urllib.parse import urlparse
-
-import httpx
-from bs4 import BeautifulSoup
-from fake_useragent import UserAgent
+import time
+
 from telegram import Update, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
 import bot.models
-from bot.api.google import GoogleApi
-from bot.api.google_maps import GoogleMapsApi
+from bot.api.google import GoogleApi, run_google_call
 from bot.context.message_forwarder import MessageForwarder, logger
+from bot.context.render_cache import get_render_cache_stats
 from bot.data_manager import DataManager
 from bot.db import get_recent_users, get_users_with_subscription, get_all_users, get_address_without_link, \
-    write_data_to_geodata_table, get_addresses_with_link
+    write_data_to_geodata_table, get_addresses_with_link, get_facets_cache_stats, get_data_version, \
+    write_geodata_rows
+from bot.geocoding import Geocoder, create_client, parse_lat_lng_from_url, get_address_geocoder
+from bot.listing_index import rebuild_listing_index
 from bot.navigation.basic_keyboard_builder import show_menu
 from bot.navigation.buttons_constants import ADMIN_BUTTONS, get_regular_btn, HOME_MENU_BTN_TEXT, SUBMIT_BTN
 from bot.navigation.constants import ADMIN_MENU_STAGE, MAIN_MENU_STATE, GEO_DATA_STAGE
 from bot.notifications import notify_admins
-from bot.proxies import get_proxies
+from bot.proxies import get_proxy_pool
 
 
 async def get_recent_hour_users(
@@ -76,6 +72,46 @@ async def get_total_users(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return ADMIN_MENU_STAGE
 
 
+async def get_cache_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    text = f"Версія даних: {get_data_version()}\n"
+    caches = {
+        "Кеш фільтрів": get_facets_cache_stats(),
+        "Кеш клавіатур": get_render_cache_stats(),
+    }
+    for name, stats in caches.items():
+        text += f"\n{name}:\n" \
+                f"Влучань: {stats['hits']}\n" \
+                f"Промахів: {stats['misses']}\n" \
+                f"Записів: {stats['size']} з {stats['maxsize']}\n"
+    await show_menu(update=update,
+                    context=context,
+                    text=text,
+                    buttons_pattern=ADMIN_BUTTONS,
+                    admin_menu=True)
+    return ADMIN_MENU_STAGE
+
+
+async def get_proxy_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    stats = get_proxy_pool().get_stats()
+    text = f"Робочих проксі: {stats['healthy']}\n" \
+           f"Видалено: {stats['evicted']}\n" \
+           f"Успішних запитів: {stats['successes']}\n" \
+           f"Невдалих запитів: {stats['failures']}\n"
+    if stats['refreshed_at'] is None:
+        text += "Ще не перевірялись\n"
+    else:
+        text += f"Перевірені {int(time.monotonic() - stats['refreshed_at']) // 60} хв тому\n"
+    for proxy in stats['best']:
+        latency = f"{proxy.latency:.2f} с" if proxy.latency is not None else "-"
+        text += f"\n{proxy.address}: {latency}, успішних {proxy.success_rate:.0%}"
+    await show_menu(update=update,
+                    context=context,
+                    text=text,
+                    buttons_pattern=ADMIN_BUTTONS,
+                    admin_menu=True)
+    return ADMIN_MENU_STAGE
+
+
 async def check_geolink(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     address_data = await get_address_without_link()
     if address_data is None:
@@ -90,10 +126,9 @@ async def check_geolink(update: Update, context: ContextTypes.DEFAULT_TYPE) -> s
     context.user_data["address_pk"] = address_data.address
     context.user_data["district_pk"] = address_data.district
 
-    google_query, text = address_data.build_google_query_and_user_text()
+    _, text = address_data.build_google_query_and_user_text()
 
-    api = GoogleMapsApi()
-    geodata_result = api.get_geodata_by_address(google_query)
+    geodata_result = await get_address_geocoder().geocode(address_data)
 
     home_menu_btn = get_regular_btn(text=HOME_MENU_BTN_TEXT, callback=MAIN_MENU_STATE)
 
@@ -150,16 +185,17 @@ async def submit_geolink(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                                       map_link=geodata_result["google_maps_link"],
                                       coordinates=geodata_result["coordinates"],
                                       )
+    await rebuild_listing_index(bot.models.Apartments)
     name = 'Квартири'
-    api = GoogleApi()
-    spreadsheet_data = api.get_sheet_data(name)
+    api = await run_google_call(GoogleApi)
+    spreadsheet_data = await run_google_call(api.get_sheet_data, name)
     idxs = []
     for i, row in enumerate(spreadsheet_data):
 
         if context.user_data["address_pk"] in row and context.user_data["district_pk"] in row:
             idxs.append(i)
     link = geodata_result["google_maps_link"]
-    api.batch_update_google_maps_link_by_row_idx(idxs, link)
+    await run_google_call(api.batch_update_google_maps_link_by_row_idx, idxs, link)
     text = f"Посилання на гугл мапс для всіх обʼєктів з цією адресою встановлено."
 
     await show_menu(update=update,
@@ -170,10 +206,11 @@ async def submit_geolink(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return ADMIN_MENU_STAGE
 
 
-async def sync_data(forwarder: MessageForwarder):
+async def sync_data(forwarder: MessageForwarder, force: bool = False):
     data_manager = DataManager()
-    await data_manager.sync_data()
-    await data_manager.notify_users(forwarder)
+    # Nothing new to notify about if the spreadsheet hasn't changed
+    if await data_manager.sync_data(force=force):
+        await data_manager.notify_users(forwarder)
 
 
 def create_refresh_handler(forwarder: MessageForwarder):
@@ -186,7 +223,7 @@ def create_refresh_handler(forwarder: MessageForwarder):
                         text=text,
                         buttons_pattern=ADMIN_BUTTONS,
                         admin_menu=True)
-        await sync_data(forwarder=forwarder)
+        await sync_data(forwarder=forwarder, force=True)
         text = "Перевіряю координати..."
         await show_menu(update=update,
                         context=context,
@@ -195,6 +232,7 @@ def create_refresh_handler(forwarder: MessageForwarder):
                         admin_menu=True)
         #todo:try except ???
         await write_coordinates_to_db_from_gmaps_link(context)
+        await rebuild_listing_index(bot.models.Apartments)
         text = "База даних оновлена.\nГарного вам дня 😊"
         await show_menu(update=update,
                         context=context,
@@ -209,83 +247,22 @@ def create_refresh_handler(forwarder: MessageForwarder):
 async def write_coordinates_to_db_from_gmaps_link(context: ContextTypes.DEFAULT_TYPE):
     model = bot.models.Apartments
     result = await get_addresses_with_link(model)
-    added_addresses = set()
-    proxies = await get_proxies()
-    proxy_pool = cycle(proxies)
-    for count, el in enumerate(result):
-        address_key = f'{el.address}-{el.district}'
-        if count == 0 or count % 10 == 0:
-            proxy = next(proxy_pool)
-            proxies = {"http://": f'http://{proxy}'}
-        if address_key in added_addresses:
-            print(f'This address was already validated: {el}')
-            continue
-        lat_lng = await get_lat_lng(el.maps_link, proxies)
+    # Listings sharing an address share its geodata row
+    by_address = {}
+    for el in result:
+        by_address.setdefault((el.address, el.district), el)
+
+    proxy_pool = get_proxy_pool()
+    await proxy_pool.refresh_if_stale()
+    async with create_client() as client:
+        geocoder = Geocoder(client, proxy_pool=proxy_pool)
+        coordinates = await geocoder.resolve_all([el.maps_link for el in by_address.values()])
+
+    rows = []
+    for el in by_address.values():
+        lat_lng = coordinates.get(el.maps_link)
         if lat_lng:
-            await write_data_to_geodata_table(address=el.address,
-                                              district=el.district,
-                                              map_link=el.maps_link,
-                                              coordinates=lat_lng)
-            added_addresses.add(address_key)
-
+            rows.append(dict(address=el.address, district=el.district, map_link=el.maps_link, coordinates=lat_lng))
         else:
             await notify_admins(bot=context.bot, text=f'Object has broken link: {el}')
-            # text = f'Object has broken link: {el}\n______________________________________'
-
-
-def parse_lat_lng_from_url(url: str) -> Optional[dict]:
-    p = urlparse(url)
-    split_geodata = p.path.split('@')
-    if len(split_geodata) == 2:
-        list_result = split_geodata[1].split(',')[0:2]
-        return {'lat': list_result[0],
-                'lng': list_result[1]}
-    return None
-
-
-def parse_lat_lng_from_content(response: httpx.Response) -> Optional[dict]:
-    page_content = response.content
-    soup = BeautifulSoup(page_content)
-    data = soup.find_all("meta", itemprop="image")
-    if len(data):
-        link = str(data[0])
-        coordinates = parse_lat_lng_from_url_query(link)
-        return coordinates
-    return None
-
-
-def parse_lat_lng_from_url_query(url: str) -> Optional[dict]:
-    enc_query = urllib.parse.unquote(urlparse(url).query)
-    if enc_query:
-        geos_unparsed = enc_query.split(';')[0].split(',')
-        if len(geos_unparsed) >= 2:
-            lat = re.findall(r"[+-]?[0-9]*[.][0-9]+", geos_unparsed[0])
-            lng = re.findall(r"[+-]?[0-9]*[.][0-9]+", geos_unparsed[1])
-            if lat[0] and lng[0]:
-                coordinates = {'lat': float(lat[0]), 'lng': float(lng[0])}
-                print(f'{coordinates=}')
-                return coordinates
-    return None
-
-
-async def get_lat_lng(link: str, proxies) -> Optional[dict]:
-    first_try = parse_lat_lng_from_url(link)
-    if first_try:
-        return first_try
-    user_agent = UserAgent()
-    headers = {'user-agent': user_agent.random}
-    async with httpx.AsyncClient(proxies=proxies, follow_redirects=True, headers=headers) as client:
-        r = await client.get(link)
-        print(f'short_url:{link}\nURL: {r.url}\nCODE: {r.status_code}')
-    if r.status_code < 400:
-        if '@' in str(r.url):
-            second_try = parse_lat_lng_from_url(str(r.url))
-            if second_try:
-                return second_try
-        third_try = parse_lat_lng_from_content(r)
-        if third_try:
-            return third_try
-        last_try = parse_lat_lng_from_url_query(str(r.url))
-        if last_try:
-            return last_try
-    return None
+    await write_geodata_rows(rows)
@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+
+from bot import data_manager
+from bot.api.google import join_column_spans
+from bot.data_manager import DataManager
+
+
+class FakeApi:
+    """Sheets as lists of rows, ranges are answered like batchGet does"""
+
+    def __init__(self, sheets, row_counts=None):
+        self.sheets = sheets
+        if row_counts is None:
+            row_counts = {name: len(rows) for name, rows in sheets.items()}
+        self.row_counts = row_counts
+        self.requests = []
+
+    def get_sheet_row_counts(self):
+        return dict(self.row_counts)
+
+    def get_sheets_rows(self, columns, first_row, last_row):
+        self.requests.append((sorted(columns), first_row, last_row))
+        for name in columns:
+            if last_row > len(self.sheets[name]):
+                raise HttpError(
+                    Response({"status": 400}), b"Range exceeds grid limits. Max rows: 1"
+                )
+        result = {}
+        for name in columns:
+            rows = self.sheets[name][first_row - 1 : last_row]
+            # Trailing blank rows of a range are omitted
+            while rows and not any(rows[-1]):
+                rows = rows[:-1]
+            result[name] = rows
+        return result
+
+
+def fetch(api):
+    queues = {name: asyncio.Queue() for name in api.sheets}
+    asyncio.run(
+        DataManager.fetch_pages(api, {name: ["id"] for name in api.sheets}, queues)
+    )
+    result = {}
+    for name, queue in queues.items():
+        pages = []
+        while (page := queue.get_nowait()) is not None:
+            pages.append(page)
+        assert queue.empty()
+        result[name] = pages
+    return result
+
+
+@pytest.fixture(autouse=True)
+def page_size(monkeypatch):
+    monkeypatch.setattr(data_manager, "SHEET_PAGE_SIZE", 3)
+
+
+def test_pages_end_at_the_grid():
+    api = FakeApi({"A": [["id"], ["1"], ["2"], ["3"], ["4"]], "B": [["id"], ["1"]]})
+
+    assert fetch(api) == {
+        "A": [[["id"], ["1"], ["2"]], [["3"], ["4"]]],
+        "B": [[["id"], ["1"]]],
+    }
+    # No page is requested past the last row
+    assert api.requests == [(["A"], 1, 3), (["B"], 1, 2), (["A"], 4, 5)]
+
+
+def test_blank_page_is_not_the_end():
+    api = FakeApi({"A": [["id"], ["1"], [], [], [], [], ["6"], [], []]})
+
+    assert fetch(api) == {"A": [[["id"], ["1"]], [], [["6"]]]}
+
+
+def test_sheet_shortened_during_sync():
+    api = FakeApi(
+        {"A": [["id"], ["1"], ["2"], ["3"], ["4"]], "B": [["id"], ["1"], ["2"]]},
+        row_counts={"A": 5, "B": 6},
+    )
+
+    assert fetch(api) == {
+        "A": [[["id"], ["1"], ["2"]], [["3"], ["4"]]],
+        "B": [[["id"], ["1"], ["2"]]],
+    }
+
+
+def test_missing_sheet():
+    api = FakeApi({"A": [["id"]]}, row_counts={})
+
+    with pytest.raises(Exception, match="Missing sheets"):
+        fetch(api)
+
+
+def test_join_column_spans():
+    parts = [
+        ([["1", "Печерський"], ["2"], [], ["4", "Оболонський"]], 2),
+        ([["так"], [], [], [], [""]], 1),
+    ]
+
+    assert join_column_spans(parts) == [
+        ["1", "Печерський", "так"],
+        ["2"],
+        [],
+        ["4", "Оболонський"],
+        [],
+    ]
+
+
+def test_truncated_rows_are_skipped():
+    header = [
+        "№",
+        "Район",
+        "Вулиця",
+        "ЖК",
+        "К",
+        "Ціна",
+        "Вал",
+        "Опис",
+        "Актуальність",
+        "Д",
+        "Т",
+        "G",
+    ]
+    row = [
+        "1",
+        "Печерський",
+        "Лесі Українки 1",
+        "ЖК Файна",
+        "2",
+        "20 000",
+        "UAH",
+        "https://t.me/c/1/1",
+    ]
+    data = [row, row[:5], [], row + ["", "Д"]]
+
+    result = list(
+        DataManager().iter_sheet_rows(header, data, data_manager.MAPPING_APARTS)
+    )
+
+    assert [r["id"] for r in result] == [1, 1]
+    assert result[1]["kids"] == data_manager.ALL_KIDS_ALLOWED_PROP
+    assert "maps_link" not in result[0]
@@ -0,0 +1,44 @@
+import asyncio
+
+import httpx
+
+from bot import geocoding
+from bot.geocoding import Geocoder, parse_lat_lng_from_url
+
+
+class FakeGeocoder(Geocoder):
+    async def get_lat_lng(self, link):
+        return parse_lat_lng_from_url(link)
+
+
+def test_bad_links_dont_fail_the_batch(monkeypatch):
+    saved = {}
+
+    async def get_cached_map_links(links):
+        return {}
+
+    async def save_map_links(coordinates):
+        saved.update(coordinates)
+
+    monkeypatch.setattr(geocoding, "get_cached_map_links", get_cached_map_links)
+    monkeypatch.setattr(geocoding, "save_map_links", save_map_links)
+    links = [
+        "https://www.google.com/maps/place/@50.45,30.52,17z",
+        # No comma after @
+        "https://www.google.com/maps/place/@50.45z",
+        # Not a number
+        "https://www.google.com/maps/place/@lat,lng,17z",
+    ]
+
+    async def run():
+        async with httpx.AsyncClient() as client:
+            return await FakeGeocoder(client).resolve_all(links)
+
+    result = asyncio.run(run())
+
+    assert result == {
+        links[0]: {"lat": 50.45, "lng": 30.52},
+        links[1]: None,
+        links[2]: None,
+    }
+    assert saved == {links[0]: {"lat": 50.45, "lng": 30.52}}
@@ -0,0 +1,44 @@
+import asyncio
+
+import httpx
+import pytest
+
+from bot.api.google_maps import GoogleMapsApi
+
+LOCATION = {"lat": 50.45, "lng": 30.52}
+
+
+def get_geodata(body):
+    transport = httpx.MockTransport(lambda request: httpx.Response(200, json=body))
+
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as client:
+            return await GoogleMapsApi(client).get_geodata_by_address("Хрещатик 1")
+
+    return asyncio.run(run())
+
+
+def test_found():
+    geodata = get_geodata(
+        {"status": "OK", "candidates": [{"geometry": {"location": LOCATION}}]}
+    )
+
+    assert geodata["coordinates"] == LOCATION
+
+
+def test_not_found():
+    assert get_geodata({"status": "ZERO_RESULTS", "candidates": []}) is None
+
+
+@pytest.mark.parametrize(
+    "status", ["REQUEST_DENIED", "OVER_QUERY_LIMIT", "INVALID_REQUEST", "UNKNOWN_ERROR"]
+)
+def test_error_statuses_raise(status):
+    with pytest.raises(ValueError, match=status):
+        get_geodata(
+            {
+                "status": status,
+                "candidates": [],
+                "error_message": "The provided API key is invalid.",
+            }
+        )
@@ -0,0 +1,202 @@
+import datetime
+import random
+
+import numpy as np
+import pytest
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+
+from bot.db import get_facet_order
+from bot.listing_index import ListingIndex
+from bot.models import Apartments
+from bot.spatial_index import haversine
+
+DISTRICTS = ["Печерський", "Шевченківський", "Оболонський", "Голосіївський", " "]
+COMPLEXES = ["ЖК Файна", "ЖК Respublika", "Tetris Hall", None]
+CURRENCIES = ["UAH", "USD", "EUR"]
+CENTER = (50.45, 30.52)
+
+
+@pytest.fixture
+def rows():
+    rng = random.Random(0)
+    start = datetime.datetime(2022, 1, 1)
+    rows = []
+    for i in range(1, 501):
+        located = rng.random() > 0.1
+        rows.append(
+            {
+                "id": i,
+                "link": f"https://t.me/c/1/{i}",
+                # Duplicate timestamps, ties are ordered by id
+                "created_at": start + datetime.timedelta(hours=rng.randrange(200)),
+                "price_uah": rng.choice([None, rng.uniform(5000, 50000)]),
+                "district": rng.choice(DISTRICTS),
+                "residential_complex": rng.choice(COMPLEXES),
+                "currency": rng.choice(CURRENCIES),
+                "kids": rng.choice([None, "Д", "Д6"]),
+                "pets": rng.choice([None, "Т", "П", "К"]),
+                "rooms": rng.randrange(1, 5),
+                "rent_price": rng.randrange(5000, 50000),
+                "lat": CENTER[0] + rng.uniform(-0.1, 0.1) if located else None,
+                "lng": CENTER[1] + rng.uniform(-0.1, 0.1) if located else None,
+            }
+        )
+    # Index rows come ordered like rebuild_listing_index selects them
+    rows.sort(key=lambda r: (r["created_at"], r["id"]), reverse=True)
+    return rows
+
+
+@pytest.fixture
+def index(rows):
+    return ListingIndex(Apartments, rows)
+
+
+def sql_in(rows, key, values):
+    # NULL IN (...) is never true
+    return [r for r in rows if r[key] is not None and r[key] in values]
+
+
+def sql_facets(rows, key):
+    """SELECT key, count(*) ... GROUP BY key, with NULL and blank groups skipped like collect_facets"""
+    facets = {}
+    for r in rows:
+        value = r[key]
+        if value is None or value == " ":
+            continue
+        facets[value] = facets.get(value, 0) + 1
+    return facets
+
+
+def sql_distance(rows):
+    return {
+        r["id"]: haversine(*CENTER, r["lat"], r["lng"]).item()
+        for r in rows
+        if r["lat"] is not None
+    }
+
+
+def mask_of(index, rows):
+    return index.isin("id", [r["id"] for r in rows])
+
+
+@pytest.mark.parametrize(
+    "key, values",
+    [
+        ("district", ["Печерський", "Оболонський"]),
+        ("residential_complex", ["ЖК Файна", "Невідомий"]),
+        ("kids", ["Д6"]),
+        ("rooms", [1, 3]),
+    ],
+)
+def test_isin(index, rows, key, values):
+    expected = sql_in(rows, key, values)
+
+    assert index.links_for(index.isin(key, values)) == [r["link"] for r in expected]
+
+
+@pytest.mark.parametrize(
+    "key", ["district", "residential_complex", "currency", "kids", "pets", "rooms"]
+)
+def test_facets(index, rows, key):
+    selected = sql_in(rows, "currency", ["USD", "EUR"])
+
+    assert index.facets(key, index.isin("currency", ["USD", "EUR"])) == sql_facets(
+        selected, key
+    )
+
+
+def test_facets_of_empty_mask(index):
+    assert index.facets("district", np.zeros(index.size, dtype=bool)) == {}
+
+
+def test_count(index, rows):
+    mask = index.isin("rooms", [2]) & index.isin("district", ["Печерський"])
+
+    assert index.count(mask) == len(
+        [r for r in rows if r["rooms"] == 2 and r["district"] == "Печерський"]
+    )
+    assert index.any(mask)
+
+
+def test_pages_newest_first(index, rows):
+    selected = sql_in(rows, "pets", ["Т", "К"])
+    mask = index.isin("pets", ["Т", "К"])
+
+    pages, after = [], None
+    while True:
+        page = index.page(mask, 7, after)
+        if not page:
+            break
+        pages.extend(page)
+        after = page[-1][1:]
+
+    assert [link for link, _, _ in pages] == [r["link"] for r in selected]
+
+
+def test_pages_nearest_first(index, rows):
+    distance = sql_distance(rows)
+    expected = sorted((d, id_) for id_, d in distance.items())
+
+    pages, after = [], None
+    while True:
+        page = index.page(index.all(), 9, after, CENTER)
+        if not page:
+            break
+        pages.extend(page)
+        after = page[-1][1:]
+
+    assert [(key, id_) for _, key, id_ in pages] == pytest.approx(expected)
+
+
+def test_count_within(index, rows):
+    distance = sql_distance(sql_in(rows, "rooms", [1, 2]))
+    radiuses = [500, 1000, 3000, 10000]
+
+    counts = index.count_within(index.isin("rooms", [1, 2]), *CENTER, radiuses)
+
+    assert counts == [len([d for d in distance.values() if d < r]) for r in radiuses]
+
+
+def test_within(index, rows):
+    distance = sql_distance(rows)
+    expected = [r["link"] for r in rows if distance.get(r["id"], np.inf) < 2000]
+
+    assert index.links_for(index.within(*CENTER, 2000)) == expected
+
+
+def test_rows_by_ids(index, rows):
+    ids = [rows[5]["id"], 10**6, rows[0]["id"]]
+
+    assert [link for link, _, _ in index.rows_by_ids(ids)] == [
+        rows[5]["link"],
+        rows[0]["link"],
+    ]
+
+
+def test_remove_link(index, rows):
+    link = rows[0]["link"]
+    index.remove_link(link)
+
+    assert link not in index.links_for(index.all())
+    assert index.count(index.all()) == len(rows) - 1
+    assert index.rows_by_ids([rows[0]["id"]]) == []
+
+
+def test_facets_in_code_point_order(index):
+    # Ukrainian and Latin values, buttons are addressed by position so Postgres has to agree
+    facets = index.facets("residential_complex", index.all())
+
+    assert list(facets) == ["Tetris Hall", "ЖК Respublika", "ЖК Файна"]
+
+
+def test_db_facets_in_code_point_order():
+    query = select(Apartments.residential_complex, Apartments.rooms).order_by(
+        get_facet_order(Apartments.residential_complex),
+        get_facet_order(Apartments.rooms),
+    )
+
+    assert (
+        'ORDER BY apartments.residential_complex COLLATE "C", apartments.rooms'
+        in str(query.compile(dialect=postgresql.dialect()))
+    )
@@ -0,0 +1,91 @@
+"""
+Plans of the listing queries on a seeded database, so a changed query or a dropped index
+doesn't silently turn them into sequential scans.
+Needs TEST_DB_URI of a Postgres with PostGIS, migrated with alembic upgrade head.
+Seeded rows are rolled back.
+"""
+import asyncio
+import os
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+TEST_DB_URI = os.environ.get("TEST_DB_URI")
+
+pytestmark = pytest.mark.skipif(not TEST_DB_URI, reason="TEST_DB_URI is not set")
+
+SEED_ROWS = 20000
+
+SEED = text(
+    """
+    INSERT INTO apartments (
+        id, address, rent_price, currency, link, rooms, district, residential_complex,
+        created_at, coordinates, price_uah
+    )
+    SELECT
+        1000000000 + i, 'address', 10000 + i % 1000, 'UAH', 'explain-test-' || i, 1 + i % 4,
+        'district ' || i % 100, 'complex ' || i % 500, now() - i * interval '1 minute',
+        ST_SetSRID(ST_MakePoint(30.4 + i % 200 * 0.001, 50.4 + i / 200 * 0.001), 4326)::geography,
+        10000 + i % 1000
+    FROM generate_series(1, :rows) i
+    """
+)
+
+POINT = "ST_SetSRID(ST_MakePoint(30.5, 50.45), 4326)::geography"
+
+QUERIES = [
+    ("SELECT id FROM apartments WHERE link = 'explain-test-10'", "ix_apartments_link"),
+    (
+        "SELECT link, created_at, id FROM apartments ORDER BY created_at DESC, id DESC LIMIT 10",
+        "ix_apartments_created_at_id",
+    ),
+    (
+        "SELECT link, created_at, id FROM apartments WHERE (created_at, id) < (now() - interval '1 day', 1000005000)"
+        " ORDER BY created_at DESC, id DESC LIMIT 10",
+        "ix_apartments_created_at_id",
+    ),
+    (
+        "SELECT count(*) FROM apartments WHERE district = 'district 7' AND residential_complex = 'complex 7'",
+        "ix_apartments_district_residential_complex",
+    ),
+    (
+        f"SELECT link, coordinates <-> {POINT}, id FROM apartments ORDER BY 2, id LIMIT 10",
+        "ix_apartments_coordinates",
+    ),
+    (
+        f"SELECT count(*) FROM apartments WHERE ST_DWithin(coordinates, {POINT}, 500, false)",
+        "ix_apartments_coordinates",
+    ),
+]
+
+
+async def explain_all():
+    engine = create_async_engine(TEST_DB_URI)
+    plans = []
+    try:
+        async with engine.connect() as conn:
+            transaction = await conn.begin()
+            try:
+                await conn.execute(SEED, {"rows": SEED_ROWS})
+                await conn.execute(text("ANALYZE apartments"))
+                for query, _ in QUERIES:
+                    result = await conn.execute(text(f"EXPLAIN {query}"))
+                    plans.append("\n".join(row[0] for row in result))
+            finally:
+                await transaction.rollback()
+    finally:
+        await engine.dispose()
+    return plans
+
+
+@pytest.fixture(scope="module")
+def plans():
+    return asyncio.run(explain_all())
+
+
+@pytest.mark.parametrize("i", range(len(QUERIES)))
+def test_query_uses_index(plans, i):
+    _, index_name = QUERIES[i]
+
+    assert index_name in plans[i], plans[i]
@@ -0,0 +1,21 @@
+from bot.context.snapshots import save_snapshot, get_snapshot, drop_snapshot
+from bot.models import Apartments, Houses
+
+FILTERS = '[1, [["Печерський"], null]]'
+
+
+def test_snapshot_is_of_one_search():
+    save_snapshot(1, Apartments, FILTERS, [3, 2, 1])
+
+    assert get_snapshot(1, Apartments, FILTERS).ids.tolist() == [3, 2, 1]
+    assert get_snapshot(1, Apartments, '[1, [["Оболонський"], null]]') is None
+    assert get_snapshot(1, Houses, FILTERS) is None
+    assert get_snapshot(2, Apartments, FILTERS) is None
+
+
+def test_drop_snapshot():
+    save_snapshot(1, Apartments, FILTERS, [1])
+    drop_snapshot(1)
+    drop_snapshot(1)
+
+    assert get_snapshot(1, Apartments, FILTERS) is None
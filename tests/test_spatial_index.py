@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from bot.spatial_index import SpatialGrid, haversine
+
+KYIV = (50.45, 30.52)
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    lats = KYIV[0] + rng.uniform(-0.3, 0.3, 5000)
+    lngs = KYIV[1] + rng.uniform(-0.3, 0.3, 5000)
+    # Listings without coordinates
+    lats[::50] = np.nan
+    lngs[::70] = np.nan
+    return lats, lngs
+
+
+@pytest.mark.parametrize("radius_m", [100, 1000, 5000, 30000])
+@pytest.mark.parametrize("center", [KYIV, (50.2, 30.3), (51.5, 31.0)])
+def test_within_matches_brute_force(points, center, radius_m):
+    lats, lngs = points
+    grid = SpatialGrid(lats, lngs)
+
+    distance = haversine(*center, lats, lngs)
+    expected = np.flatnonzero(distance < radius_m)
+
+    assert sorted(grid.within(*center, radius_m).tolist()) == expected.tolist()
+
+
+def test_distances_match_brute_force(points):
+    lats, lngs = points
+    grid = SpatialGrid(lats, lngs)
+
+    positions, distance = grid.distances(*KYIV, 3000)
+
+    np.testing.assert_allclose(
+        distance, haversine(*KYIV, lats[positions], lngs[positions])
+    )
+    assert (distance < 3000).all()
+
+
+def test_points_on_cell_edges():
+    lats = np.array([50.0, 50.01, 49.99, 50.0, 50.0])
+    lngs = np.array([30.0, 30.0, 30.0, 30.01, 29.99])
+    grid = SpatialGrid(lats, lngs)
+
+    assert sorted(grid.within(50.0, 30.0, 1200).tolist()) == [0, 1, 2, 3, 4]
+    assert grid.within(50.0, 30.0, 500).tolist() == [0]
+
+
+def test_empty_grid():
+    grid = SpatialGrid(np.array([np.nan]), np.array([np.nan]))
+
+    assert grid.within(*KYIV, 1000).tolist() == []